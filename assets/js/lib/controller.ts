@@ -1,11 +1,12 @@
 import {Party, PartyMember} from "./party/party";
 import {GameSession} from "./game";
 import {PartyList} from "./party/partylist";
-import {TrackList, TrackQueue} from "./tracklist";
+import {getSongMap, TrackList, TrackQueue} from "./tracklist";
 import {LocalPlayer, RemotePlayer} from "./player";
 import {Ready} from "./ready";
 import * as escapeHtml from "escape-html";
 import {SungNote} from "./audio/live";
+import {musicURL} from "page-data";
 
 export class GameController {
     private gameContainer: HTMLElement;
@@ -36,6 +37,7 @@ export class GameController {
         this.party.on('updatedPlaylist', (playlist) => this._updatePlaylist(playlist));
 
         this.trackQueue = new TrackQueue(document.getElementById('queue-scroll'));
+        this.trackQueue.on('songPicked', (song) => this.party.moveInPlaylist(song, 'front'));
 
         this.ready = new Ready(document.getElementById('ready-container'), this.party);
         this.ready.on('ready', (part) => this._handleReady(part));
@@ -54,10 +56,12 @@ export class GameController {
         }
     }
 
-    private _loadTrack(track: number): void {
+    private async _loadTrack(track: number): Promise<void> {
         document.getElementById('loading').style.display = 'block';
         this.loadingScreen = true;
-        this.session = new GameSession(this.gameContainer, window.innerWidth, window.innerHeight, `https://music.ponytone.online/${track}/notes.txt`);
+        let song = (await getSongMap())[track];
+        let notes = (song && song.notes) || 'notes.txt';
+        this.session = new GameSession(this.gameContainer, window.innerWidth, window.innerHeight, `${musicURL}${track}/${notes}`);
 
         this.session.prepare();
         this.session.on('ready', () => this._handleTrackLoaded());
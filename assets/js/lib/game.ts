@@ -1,4 +1,4 @@
-import {Song} from "./ultrastar/parser";
+import {CompiledSong, Song} from "./ultrastar/parser";
 import {GameDisplay} from "./display";
 import {LocalPlayer, Player} from "./player";
 import {getAudioContext, kickAudioContext} from "./util/audio-context";
@@ -63,7 +63,7 @@ export class GameSession extends EventEmitter implements AudioPlayer {
         try {
             await kickAudioContext();
             let response = await fetch(this.songURL);
-            this._prepare(await response.text());
+            this._prepare(this.songURL.endsWith('.json') ? await response.json() : await response.text());
         } catch (e) {
             this.emit("error", e);
         }
@@ -94,7 +94,7 @@ export class GameSession extends EventEmitter implements AudioPlayer {
         this.players.push(player);
     }
 
-    _prepare(songText: string): void {
+    _prepare(songText: string | CompiledSong): void {
         this.song = new Song(this._baseURL, songText);
 
         this.audio = this._ac.createBufferSource();
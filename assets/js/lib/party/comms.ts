@@ -3,6 +3,11 @@ import {PeerConnection} from './p2p';
 import {partyID} from 'page-data';
 import {EventEmitter} from "events";
 
+// Relayed messages to the same peer sent within this many milliseconds share a websocket frame.
+const RELAY_BATCH_WINDOW = 10;
+// The server evicts members it hasn't heard from in a minute (see sweep_parties).
+const HEARTBEAT_INTERVAL = 15000;
+
 export interface NetworkMember {
     channel: string;
     nick: string;
@@ -14,6 +19,10 @@ export class NetworkSession extends EventEmitter {
     channelName: string;
     private rtcConnections: {[key: string]: PeerConnection};
     private ws: WebSocketBridge;
+    private pendingRelays: {[key: string]: any[]};
+    private playlist: number[];
+    private playlistVersion: number;
+    private heartbeat: number;
     party: {[key: string]: NetworkMember};
 
     constructor(nick: string) {
@@ -25,6 +34,10 @@ export class NetworkSession extends EventEmitter {
         this.nick = nick;
         this.channelName = null;
         this.rtcConnections = {};
+        this.pendingRelays = {};
+        this.playlist = [];
+        this.playlistVersion = null;
+        this.heartbeat = null;
         this.party = {};
     }
 
@@ -33,8 +46,10 @@ export class NetworkSession extends EventEmitter {
     on(event: 'newMember', listener: (member: NetworkMember) => void): this;
     on(event: 'gotMemberList', listener: (list: {[key: string]: {nick: string, colour: string}}) => void): this;
     on(event: 'memberLeft', listener: (member: {nick: string, channel: string}) => void): this;
+    on(event: 'memberResumed', listener: (oldChannel: string, channel: string) => void): this;
     on(event: 'relayedMessage', listener: (origin: string, message: RelayedMessage) => void): this;
     on(event: 'updatedPlaylist', listener: (playlist: number[]) => void): this;
+    on(event: 'nextSong', listener: (song: number | null) => void): this;
     on(event: 'connectionLost', listener: (peer: string) => void): this;
     // events sent from other clients
     on(event: 'dataChannelEstablished', listener: (peer: string) => void): this;
@@ -48,7 +63,29 @@ export class NetworkSession extends EventEmitter {
     }
 
     relayTo(target: string, message: any): void {
-        this.ws.send({action: "relay", target: target, message: message})
+        if (this.pendingRelays[target]) {
+            this.pendingRelays[target].push(message);
+            return;
+        }
+        this.pendingRelays[target] = [message];
+        setTimeout(() => this._flushRelays(target), RELAY_BATCH_WINDOW);
+    }
+
+    private _sendHeartbeat(): void {
+        if (this.ws.socket.readyState === WebSocket.OPEN) {
+            this.ws.send({action: "heartbeat"});
+        }
+    }
+
+    private _flushRelays(target: string): void {
+        let messages = this.pendingRelays[target];
+        delete this.pendingRelays[target];
+        // The server forwards frames of exactly this shape without re-encoding them, so keep the key order.
+        if (messages.length === 1) {
+            this.ws.send({action: "relay", target: target, message: messages[0]});
+        } else {
+            this.ws.send({action: "relay", target: target, messages: messages});
+        }
     }
 
     broadcast(message: GameMessage): void {
@@ -70,11 +107,32 @@ export class NetworkSession extends EventEmitter {
         console.log(message);
         switch (message.action) {
             case "hello":
+                if (this.channelName !== null && this.channelName !== message.channel) {
+                    // We reconnected and the server resumed our membership on a new channel.
+                    console.log(`Resumed as ${message.channel} (was ${this.channelName}).`);
+                    this._renameMember(this.channelName, message.channel);
+                }
                 this.channelName = message.channel;
                 this.ws.send({action: "hello", nick: this.nick});
+                if (this.heartbeat === null) {
+                    this.heartbeat = setInterval(() => this._sendHeartbeat(), HEARTBEAT_INTERVAL);
+                }
                 this.emit("connected");
                 break;
             case "goodbye":
+                if (message.message === "replaced") {
+                    // Another tab resumed our membership. Reconnecting would just take it back, so stay closed.
+                    console.log("Replaced by another connection.");
+                    this.ws.socket.close(1000, "replaced", {keepClosed: true});
+                    clearInterval(this.heartbeat);
+                    this.heartbeat = null;
+                    for (let connection of Object.values(this.rtcConnections)) {
+                        connection.close();
+                    }
+                    alert("This party was opened somewhere else, so it has been disconnected here.");
+                    this.emit("disconnected");
+                    break;
+                }
                 console.log("rejected.");
                 this.ws.socket.close();
                 alert(`Connection rejected by the server: ${message.message}.`);
@@ -116,13 +174,36 @@ export class NetworkSession extends EventEmitter {
                 }
                 delete this.party[message.channel];
                 break;
+            case "member_resumed":
+                if (message.channel !== this.channelName) {
+                    console.log(`Member resumed: ${message.nick} (${message.old_channel} -> ${message.channel})`);
+                    this._resumeMember(message);
+                }
+                break;
             case "relay":
                 console.log(`Got a relayed message from ${message['origin']}.`);
                 this.rtcConnection(message.origin); // ensure an RTC connection exists in case it cares.
-                this.emit("relayedMessage", message.origin, message.message);
+                for (let relayed of message.messages || [message.message]) {
+                    this.emit("relayedMessage", message.origin, relayed);
+                }
                 break;
             case "playlist":
-                this.emit("updatedPlaylist", message.playlist);
+                this.playlist = message.playlist;
+                this.playlistVersion = message.version;
+                this.emit("updatedPlaylist", this.playlist);
+                break;
+            case "playlist_delta":
+                if (message.from !== this.playlistVersion) {
+                    console.log(`Missed playlist changes (have ${this.playlistVersion}, got ${message.from}); resyncing.`);
+                    this.ws.send({action: "getPlaylist"});
+                    break;
+                }
+                this._applyPlaylistOps(message.ops);
+                this.playlistVersion = message.version;
+                this.emit("updatedPlaylist", this.playlist);
+                break;
+            case "next_song":
+                this.emit("nextSong", message.song);
                 break;
         }
     }
@@ -130,22 +211,69 @@ export class NetworkSession extends EventEmitter {
     rtcConnection(peer: string): PeerConnection {
         if (!this.rtcConnections[peer]) {
             let connection = new PeerConnection(this, peer);
+            // connection.peer rather than peer throughout: it changes if the peer resumes on a new channel.
             connection.on('close', () => {
-                delete this.rtcConnections[peer];
-                this.emit('connectionLost', peer);
+                if (this.rtcConnections[connection.peer] === connection) {
+                    delete this.rtcConnections[connection.peer];
+                }
+                this.emit('connectionLost', connection.peer);
             });
-            connection.on('data', (action, message) => this.emit(action, message, peer));
-            connection.on('dataChannelAvailable', () => this.emit('dataChannelEstablished', peer));
+            connection.on('data', (action, message) => this.emit(action, message, connection.peer));
+            connection.on('dataChannelAvailable', () => this.emit('dataChannelEstablished', connection.peer));
             this.rtcConnections[peer] = connection;
         }
         return this.rtcConnections[peer];
     }
 
+    private _applyPlaylistOps(ops: PlaylistOp[]): void {
+        let playlist = this.playlist.slice();
+        for (let op of ops) {
+            switch (op.op) {
+                case "add":
+                    playlist.push(op.song);
+                    break;
+                case "remove":
+                    playlist = playlist.filter((x) => x !== op.song);
+                    break;
+                case "move":
+                    playlist = playlist.filter((x) => x !== op.song);
+                    playlist.splice(op.index, 0, op.song);
+                    break;
+            }
+        }
+        this.playlist = playlist;
+    }
+
+    private _renameMember(oldChannel: string, channel: string): void {
+        if (this.party[oldChannel]) {
+            this.party[channel] = {...this.party[oldChannel], channel};
+            delete this.party[oldChannel];
+        }
+        this.emit("memberResumed", oldChannel, channel);
+    }
+
+    private _resumeMember(message: MemberResumedMessage): void {
+        let {old_channel, channel} = message;
+        let rtc = this.rtcConnections[old_channel];
+        delete this.rtcConnections[old_channel];
+        this._renameMember(old_channel, channel);
+        if (rtc && rtc.alive) {
+            // The data channel never noticed the websocket drop, so there's nothing to renegotiate.
+            rtc.peer = channel;
+            this.rtcConnections[channel] = rtc;
+            return;
+        }
+        if (rtc) {
+            rtc.close();
+        }
+        this._establishConnection(message);
+    }
+
     _newMember(member: NetworkMember): void {
         this.party[member.channel] = {...member};
     }
 
-    _establishConnection(message: NewMemberMessage) {
+    _establishConnection(message: NewMemberMessage | MemberResumedMessage) {
         let {channel} = message;
         let rtc = this.rtcConnection(channel);
         rtc.connect();
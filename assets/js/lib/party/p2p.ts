@@ -3,7 +3,7 @@ import {EventEmitter} from "events";
 import {NetworkSession} from "./comms";
 
 export class PeerConnection extends EventEmitter {
-    private peer: string;
+    peer: string;
     private networkSession: NetworkSession;
     private connection: RTCPeerConnection;
     private dataStream: RTCDataChannel;
@@ -36,9 +36,14 @@ export class PeerConnection extends EventEmitter {
         this._createConnection();
         this.dataStream = this.connection.createDataChannel(`p2p-${this.peer}`);
         this.dataStream.onopen = () => this._handleDataOpen();
+        this.dataStream.onclose = () => this.dataAvailable = false;
         this.dataStream.onmessage = (e) => this._handleDataMessage(e.data);
     }
 
+    get alive(): boolean {
+        return this.dataAvailable && this.dataStream.readyState === "open";
+    }
+
     close(): void {
         if (this.connection) {
             this.connection.close();
@@ -71,6 +76,10 @@ export class PeerConnection extends EventEmitter {
 
     private async _receiveConnection(sdp: any): Promise<void> {
         try {
+            if (this.connection) {
+                // The peer is renegotiating after resuming, so start again from scratch.
+                this._discardConnection();
+            }
             this._createConnection();
             let desc = new RTCSessionDescription(sdp);
             await this.connection.setRemoteDescription(desc);
@@ -112,6 +121,15 @@ export class PeerConnection extends EventEmitter {
         this._pendingCandidates = null;
     }
 
+    private _discardConnection(): void {
+        this.connection.oniceconnectionstatechange = null;
+        this.connection.close();
+        this.connection = null;
+        this.dataStream = null;
+        this.dataAvailable = false;
+        this._pendingCandidates = [];
+    }
+
     private _createConnection(): void {
         this.connection = new RTCPeerConnection({
             iceServers: [{
@@ -182,6 +200,7 @@ export class PeerConnection extends EventEmitter {
         console.log('got a data channel', stream);
         this.dataStream = stream;
         this.dataStream.onopen = () => this._handleDataOpen();
+        this.dataStream.onclose = () => this.dataAvailable = false;
         this.dataStream.onmessage = (e) => this._handleDataMessage(e.data);
     }
 
@@ -47,12 +47,14 @@ export class Party extends EventEmitter {
         this.network.on('gotMemberList', (members) => this._handleMemberList(members));
         this.network.on('newMember', (member) => this._handleNewMember(member));
         this.network.on('memberLeft', (member) => this._handleMemberLeft(member));
+        this.network.on('memberResumed', (oldChannel, channel) => this._handleMemberResumed(oldChannel, channel));
         this.network.on('readyToGo', (message, peer) => this._handleReady(peer, message.part));
         this.network.on('dataChannelEstablished', (peer) => this._handleDataReady(peer));
         this.network.on('startGame', (message) => this._handleStartGame(message.time));
         this.network.on('loadTrack', (message) => this._handleLoadTrack(message.track));
         this.network.on('trackLoaded', (message, peer) => this._handleTrackLoaded(peer));
         this.network.on('updatedPlaylist', (songs) => this._handleUpdatedPlaylist(songs));
+        this.network.on('nextSong', (song) => this._handleNextSong(song));
         this.network.on('sangNotes', (message, peer) => this._updateScore(peer, message.score));
     }
 
@@ -83,9 +85,11 @@ export class Party extends EventEmitter {
     }
 
     _handleMemberList(members: {[key: string]: {nick: string, colour: string}}): void {
+        // After a reconnect we get the list again; keep what we already knew about anyone still here.
+        let previous = this.party;
         this.party = {};
         for (let [channel, {nick, colour}] of Object.entries(members)) {
-            this.party[channel] = this._makeMember(nick, colour);
+            this.party[channel] = previous[channel] ? {...previous[channel], nick, colour} : this._makeMember(nick, colour);
             if (this.network.channelName === channel) {
                 this.party[channel].me = true;
             }
@@ -112,6 +116,16 @@ export class Party extends EventEmitter {
         this.emit('partyUpdated');
     }
 
+    _handleMemberResumed(oldChannel: string, channel: string): void {
+        for (let party of [this.party, this.sessionParty]) {
+            if (party && party[oldChannel]) {
+                party[channel] = party[oldChannel];
+                delete party[oldChannel];
+            }
+        }
+        this.emit('partyUpdated');
+    }
+
     async _handleDataReady(peer: string): Promise<void> {
         this.party[peer].data = true;
         this.emit('partyUpdated');
@@ -160,12 +174,15 @@ export class Party extends EventEmitter {
     }
 
     _broadcastTrack(): void {
-        let song = this.queue[0];
+        // The server takes the song off the queue and tells us which it was; see _handleNextSong.
+        this.network.sendToServer({action: "popQueue"});
+    }
+
+    _handleNextSong(song: number | null): void {
         if (!song) {
             song = (Math.random() * 900)|0;
         }
         this.network.broadcast({action: "loadTrack", track: song});
-        this.network.sendToServer({action: "removeFromQueue", song: song});
         this._handleLoadTrack(song);
     }
 
@@ -228,6 +245,10 @@ export class Party extends EventEmitter {
         this.network.sendToServer({action: "addToQueue", song: id});
     }
 
+    moveInPlaylist(id: number, direction: 'front' | 'up' | 'down'): void {
+        this.network.sendToServer({action: "moveInQueue", song: id, direction});
+    }
+
     get isMaster(): boolean {
         let peers = Object.keys(this.sessionParty || this.party);
         peers.sort();
@@ -1,6 +1,7 @@
 "use strict";
 import * as Clusterize from 'clusterize.js';
 import {EventEmitter} from "events";
+import {musicURL} from "page-data";
 
 export interface SongIndexEntry {
     id: number;
@@ -9,6 +10,9 @@ export interface SongIndexEntry {
     length: number;
     cover: string;
     duet?: string[];
+    notes?: string;
+    preview?: string;
+    gain?: number;
 }
 
 export interface SongIndexMap {
@@ -26,7 +30,7 @@ function formatDuration(seconds: number): string {
 
 function renderSong(songInfo: SongIndexEntry): string {
     return `<li data-song="${songInfo.id}">
-        <img src="//music.ponytone.online/${songInfo.id}/${songInfo.cover}">
+        <img src="${musicURL}${songInfo.id}/${songInfo.cover}">
         <span class="song-title">${songInfo.title}</span>
         <span class="song-artist">${songInfo.artist}</span>
         <span class="duration">${formatDuration(songInfo.length)}</span>
@@ -136,14 +140,16 @@ export class TrackList extends EventEmitter {
     }
 }
 
-export class TrackQueue {
+export class TrackQueue extends EventEmitter {
     private container: HTMLElement;
     private ul: HTMLUListElement;
     private cluster: Clusterize;
 
     constructor(container: HTMLElement) {
+        super();
         this.container = container;
         this.ul = document.createElement('ul');
+        this.ul.onclick = (e) => this._handleClick(e);
         this.container.innerHTML = '';
         this.container.appendChild(this.ul);
         this.cluster = new Clusterize({
@@ -157,6 +163,19 @@ export class TrackQueue {
         });
     }
 
+    // Clicking a queued song plays it next.
+    on(event: 'songPicked', listener: (song: number) => any): this {
+        return super.on(event, listener);
+    }
+
+    private _handleClick(e: MouseEvent): void {
+        let item = (<HTMLElement>e.target).closest('li');
+        if (!item || !item.dataset.song) {
+            return;
+        }
+        this.emit('songPicked', parseInt(item.dataset.song, 10));
+    }
+
     async updateQueue(playlist: number[]): Promise<void> {
         let map = await getSongMap();
         this.cluster.update(playlist.map((i) => renderSong(map[i])));
@@ -30,6 +30,24 @@ export interface NoteLine {
 
 type Part = NoteLine[];
 
+type CompiledNote = [NoteType, number, number, number, string];
+type CompiledLine = [number, number, CompiledNote[]];
+
+// Produced by karaoke/ultrastar.py when songs are imported.
+export interface CompiledSong {
+    v: number;
+    metadata: SongMetadata;
+    mp3: string;
+    background: string;
+    video: string;
+    bpm: number;
+    gap: number;
+    start: number;
+    end: number;
+    videogap: number;
+    parts: CompiledLine[][];
+}
+
 export class Song {
     baseURL: string;
     metadata: SongMetadata;
@@ -45,7 +63,7 @@ export class Song {
     private _video: string;
 
 
-    constructor(baseURL: string, text: string) {
+    constructor(baseURL: string, text: string | CompiledSong) {
         this.baseURL = baseURL;
         this.metadata = {};
         this.parts = [];
@@ -57,7 +75,11 @@ export class Song {
         this._background = null;
         this._video = null;
         this.videogap = 0;
-        this.parse(text);
+        if (typeof text === 'string') {
+            this.parse(text);
+        } else {
+            this.load(text);
+        }
     }
 
     getLine(time: number, part?: number): SongLine {
@@ -137,6 +159,28 @@ export class Song {
         }
     }
 
+    load(compiled: CompiledSong): void {
+        this.metadata = compiled.metadata;
+        this.bpm = compiled.bpm;
+        this.gap = compiled.gap;
+        this.start = compiled.start;
+        this.end = compiled.end;
+        this.videogap = compiled.videogap;
+        this._mp3 = compiled.mp3;
+        this._background = compiled.background;
+        this._video = compiled.video;
+        this.parts = compiled.parts.map((part) => part.map(([start, end, notes]) => {
+            let line: NoteLine = {
+                start,
+                notes: notes.map(([type, beat, length, pitch, text]) => ({type, beat, length, pitch, text})),
+            };
+            if (end) {
+                line.end = end;
+            }
+            return line;
+        }));
+    }
+
     _parseNote(line: string): Note {
         let content = line.split(' ', 4);
         let type = content[0];
@@ -11,7 +11,7 @@ async function getServerTime(): Promise<void> {
     let response = await fetch(`/ntp?t=${Date.now()}`);
     let text = await response.text();
 
-    let [offset, originalTime] = text.split(':').map((x) => parseInt(x, 10));
+    let [offset, originalTime] = text.split(':').map((x) => parseFloat(x));
     let delay = (Date.now() - originalTime) / 2;
     offset -= delay;
     serverTimes.push(offset);
@@ -11,6 +11,7 @@ interface HelloMessage {
 
 interface GoodbyeMessage {
     action: 'goodbye';
+    // "room_full", or "replaced" when another socket has resumed this member.
     message: string;
 }
 
@@ -33,15 +34,49 @@ interface MemberLeftMessage {
     nick: string;
 }
 
+// A member whose websocket dropped came back (within the server's grace period) on a new channel.
+interface MemberResumedMessage {
+    action: 'member_resumed';
+    old_channel: string;
+    channel: string;
+    nick: string;
+    colour: string;
+    id: number;
+}
+
 interface RelayMessage {
     action: 'relay';
     origin: string;
-    message: any;
+    message?: any;
+    messages?: any[];
 }
 
 interface PlaylistMessage {
     action: 'playlist';
     playlist: number[];
+    version: number;
+}
+
+interface PlaylistOp {
+    op: 'add' | 'remove' | 'move';
+    song: number;
+    version: number;
+    index?: number;  // for 'move', where the song ends up
+}
+
+interface PlaylistDeltaMessage {
+    action: 'playlist_delta';
+    from: number;
+    version: number;
+    ops: PlaylistOp[];
+}
+
+interface GetPlaylistMessage {
+    action: 'getPlaylist';
+}
+
+interface HeartbeatMessage {
+    action: 'heartbeat';
 }
 
 interface RemoveFromQueueMessage {
@@ -54,8 +89,25 @@ interface AddToQueueMessage {
     song: number;
 }
 
+interface MoveInQueueMessage {
+    action: 'moveInQueue';
+    song: number;
+    direction: 'front' | 'up' | 'down';
+}
+
+interface PopQueueMessage {
+    action: 'popQueue';
+}
+
+interface NextSongMessage {
+    action: 'next_song';
+    song: number | null;
+}
+
 type WebsocketMessage = HelloMessage | GoodbyeMessage | NewMemberMessage | MemberListMessage |
-    MemberLeftMessage | RelayMessage | PlaylistMessage | RemoveFromQueueMessage | AddToQueueMessage;
+    MemberLeftMessage | MemberResumedMessage | RelayMessage | PlaylistMessage | PlaylistDeltaMessage | GetPlaylistMessage |
+    RemoveFromQueueMessage | AddToQueueMessage | MoveInQueueMessage | PopQueueMessage | NextSongMessage |
+    HeartbeatMessage;
 
 
 // Messages sent via RelayMessage
@@ -70,6 +70,8 @@ declare module "reconnecting-websocket" {
 
     class ReconnectingWebSocket extends WebSocket {
         constructor(url: string, protocols?: string | string[], options?: ReconnectingWebSocketOptions);
+        // Without keepClosed, close() just reconnects.
+        close(code?: number, reason?: string, options?: {keepClosed?: boolean}): void;
     }
 }
 
@@ -122,6 +124,7 @@ declare module "events" {
 
 declare module "page-data" {
     const partyID: string;
+    const musicURL: string;
     const turnAuth: {username: string, password: string};
 }
 
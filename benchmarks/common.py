@@ -0,0 +1,21 @@
+"""Helpers shared by the benchmark scripts."""
+import subprocess
+import time
+
+
+def percentile(samples, fraction):
+    """Returns the sample fraction (e.g. 0.99) of the way through samples, which must be sorted and non-empty."""
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run_metadata(args, exclude=('output',)):
+    """Returns the commit, time and command line options to record alongside a run's results."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.time(),
+        'config': {k: v for k, v in vars(args).items() if k not in exclude},
+    }
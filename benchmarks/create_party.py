@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Measures party creation throughput and latency against a running Ponytone server.
+
+Each worker thread gets a CSRF cookie once and then creates parties back to back through /party/create. Results
+are written as JSON so runs can be compared across commits:
+
+    $ python benchmarks/create_party.py http://localhost:8000 --requests 5000 --concurrency 32
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common import percentile, run_metadata
+
+
+def worker(url, count, latencies, ids, errors):
+    session = requests.Session()
+    session.get(f"{url}/").raise_for_status()
+    headers = {'X-CSRFToken': session.cookies['csrftoken'], 'Referer': f"{url}/"}
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            response = session.post(f"{url}/party/create", headers=headers)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            errors.append(type(e).__name__)
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids.append(response.text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', help="Base URL of the server, e.g. http://localhost:8000")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--output', default='create_party.json')
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+
+    latencies, ids, errors = [], [], []
+    per_worker = [args.requests // args.concurrency + (i < args.requests % args.concurrency)
+                  for i in range(args.concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for future in [pool.submit(worker, args.url, n, latencies, ids, errors) for n in per_worker]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        **run_metadata(args),
+        'elapsed_s': elapsed,
+        'created': len(ids),
+        'duplicates': len(ids) - len(set(ids)),
+        'errors': len(errors),
+        'per_second': len(ids) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) if latencies else None,
+        'max_ms': latencies[-1] if latencies else None,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    print(f"Created {result['created']} parties in {elapsed:.1f}s ({result['per_second']:.0f}/s), "
+          f"{result['duplicates']} duplicate ids, {result['errors']} errors")
+    if latencies:
+        print(f"  p50={result['p50_ms']:.1f}ms p99={result['p99_ms']:.1f}ms max={result['max_ms']:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""Drives a running Ponytone server with simulated parties over the real websocket protocol.
+
+Each party is created through /party/create and joined by several members, who then say hello, relay messages to
+each other and add and remove songs from the queue. Latencies are reported per action, and the full results are
+written as JSON so runs can be compared across commits:
+
+    $ python benchmarks/loadtest.py http://localhost:8000 --parties 200 --members 6 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import requests
+import websockets
+
+from common import percentile, run_metadata
+
+
+class Stats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sent = 0
+        self.received = 0
+
+    def record(self, action, seconds):
+        self.samples[action].append(seconds * 1000)
+
+    def summary(self):
+        result = {}
+        for action, samples in sorted(self.samples.items()):
+            samples.sort()
+            result[action] = {
+                'count': len(samples),
+                'p50_ms': percentile(samples, 0.5),
+                'p99_ms': percentile(samples, 0.99),
+                'max_ms': samples[-1],
+            }
+        return result
+
+
+class Member:
+    def __init__(self, stats, base_url, party_id, nick):
+        self.stats = stats
+        self.base_url = base_url
+        self.party_id = party_id
+        self.nick = nick
+        self.channel = None
+        self.ws = None
+        self.waiters = []
+        self.playlist = []
+        self.reader = None
+
+    def _open_session(self):
+        session = requests.Session()
+        session.get(f"{self.base_url}/{self.party_id}").raise_for_status()
+        return '; '.join(f"{k}={v}" for k, v in session.cookies.items())
+
+    async def connect(self):
+        cookies = await asyncio.get_event_loop().run_in_executor(None, self._open_session)
+        url = urlparse(self.base_url)
+        ws_url = f"{'wss' if url.scheme == 'https' else 'ws'}://{url.netloc}/karaoke/party/{self.party_id}"
+        start = time.perf_counter()
+        self.ws = await websockets.connect(ws_url, extra_headers={'Cookie': cookies, 'Origin': self.base_url},
+                                           max_queue=None)
+        self.reader = asyncio.ensure_future(self._read())
+        hello = await self.wait_for(lambda m: m['action'] in ('hello', 'goodbye'))
+        if hello['action'] == 'goodbye':
+            raise RuntimeError(f"Rejected: {hello['message']}")
+        self.stats.record('connect', time.perf_counter() - start)
+        self.channel = hello['channel']
+
+    async def hello(self):
+        start = time.perf_counter()
+        await self.send({"action": "hello", "nick": self.nick})
+        await self.wait_for(lambda m: m['action'] == 'new_member' and m['channel'] == self.channel)
+        self.stats.record('hello', time.perf_counter() - start)
+
+    async def send(self, message):
+        self.stats.sent += 1
+        await self.ws.send(json.dumps(message, separators=(',', ':')))
+
+    def wait_for(self, predicate, timeout=30):
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.append((predicate, future))
+        return asyncio.wait_for(future, timeout)
+
+    async def _read(self):
+        async for frame in self.ws:
+            self.stats.received += 1
+            message = json.loads(frame)
+            if message['action'] == 'playlist':
+                self.playlist = message['playlist']
+            elif message['action'] == 'playlist_delta':
+                for op in message['ops']:
+                    if op['op'] == 'add':
+                        self.playlist.append(op['song'])
+                    elif op['op'] == 'remove':
+                        self.playlist = [x for x in self.playlist if x != op['song']]
+                    elif op['op'] == 'move':
+                        self.playlist = [x for x in self.playlist if x != op['song']]
+                        self.playlist.insert(op['index'], op['song'])
+            elif message['action'] == 'relay':
+                for relayed in message.get('messages', [message.get('message')]):
+                    if isinstance(relayed, dict) and 'sent' in relayed:
+                        self.stats.record('relay', time.time() - relayed['sent'])
+            for waiter in self.waiters[:]:
+                predicate, future = waiter
+                if future.done():
+                    self.waiters.remove(waiter)
+                elif predicate(message):
+                    self.waiters.remove(waiter)
+                    future.set_result(message)
+
+    async def relay(self, target):
+        await self.send({"action": "relay", "target": target,
+                         "message": {"action": "new-ice-candidate", "candidate": "x" * 200, "sent": time.time()}})
+
+    async def queue(self, action, song, present):
+        start = time.perf_counter()
+        await self.send({"action": action, "song": song})
+        await self.wait_for(lambda m: m['action'] in ('playlist', 'playlist_delta') and
+                            (song in self.playlist) == present)
+        self.stats.record(action, time.perf_counter() - start)
+
+    async def move_to_front(self, song):
+        if self.playlist[:1] == [song]:
+            # Nothing would change, so nothing would be broadcast.
+            return
+        start = time.perf_counter()
+        await self.send({"action": "moveInQueue", "song": song, "direction": "front"})
+        await self.wait_for(lambda m: m['action'] in ('playlist', 'playlist_delta') and self.playlist[:1] == [song])
+        self.stats.record('moveInQueue', time.perf_counter() - start)
+
+    async def close(self):
+        if self.ws:
+            await self.ws.close()
+        if self.reader:
+            await asyncio.wait([self.reader])
+
+
+def create_party(base_url):
+    session = requests.Session()
+    session.get(f"{base_url}/").raise_for_status()
+    response = session.post(f"{base_url}/party/create",
+                            headers={'X-CSRFToken': session.cookies['csrftoken'], 'Referer': f"{base_url}/"})
+    response.raise_for_status()
+    return response.text
+
+
+async def run_party(args, stats, songs, index):
+    loop = asyncio.get_event_loop()
+    party_id = await loop.run_in_executor(None, create_party, args.url)
+    members = [Member(stats, args.url, party_id, f"load{index}-{i}") for i in range(args.members)]
+    try:
+        for member in members:
+            await member.connect()
+            await member.hello()
+
+        for _ in range(args.relays):
+            await asyncio.gather(*(member.relay(other.channel)
+                                   for member in members for other in members if other is not member))
+
+        picks = random.sample(songs, min(len(songs), args.queue * len(members)))
+        for member, song in zip(members * args.queue, picks):
+            await member.queue('addToQueue', song, True)
+        for member, song in zip(members, reversed(picks)):
+            await member.move_to_front(song)
+        for member, song in zip(members * args.queue, picks):
+            await member.queue('removeFromQueue', song, False)
+        # Give the last relays a moment to land.
+        await asyncio.sleep(0.5)
+    except Exception as e:
+        stats.errors[type(e).__name__] += 1
+    finally:
+        await asyncio.gather(*(member.close() for member in members), return_exceptions=True)
+
+
+async def run(args):
+    stats = Stats()
+    songs = [x['id'] for x in requests.get(f"{args.url}/tracklist").json()]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            await run_party(args, stats, songs, index)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(args.parties)))
+    elapsed = time.perf_counter() - start
+    return stats, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', help="Base URL of the server, e.g. http://localhost:8000")
+    parser.add_argument('--parties', type=int, default=100)
+    parser.add_argument('--members', type=int, default=6)
+    parser.add_argument('--concurrency', type=int, default=100, help="Parties running at once")
+    parser.add_argument('--relays', type=int, default=20, help="Relay rounds between every pair of members")
+    parser.add_argument('--queue', type=int, default=2, help="Songs each member queues and then removes")
+    parser.add_argument('--output', default='loadtest.json')
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+
+    stats, elapsed = asyncio.get_event_loop().run_until_complete(run(args))
+    result = {
+        **run_metadata(args),
+        'elapsed_s': elapsed,
+        'messages_sent': stats.sent,
+        'messages_received': stats.received,
+        'messages_per_second': (stats.sent + stats.received) / elapsed,
+        'errors': dict(stats.errors),
+        'actions': stats.summary(),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    print(f"{args.parties} parties x {args.members} members in {elapsed:.1f}s, "
+          f"{result['messages_per_second']:.0f} msg/s, errors: {result['errors'] or 'none'}")
+    for action, summary in result['actions'].items():
+        print(f"  {action:16} n={summary['count']:<7} p50={summary['p50_ms']:.1f}ms p99={summary['p99_ms']:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+"""Times the views and every party websocket action, and counts their queries, against catalogues of several sizes.
+
+Runs in-process, against a throwaway test database and a Redis database that it flushes (so don't point --redis-url
+at one you care about), seeding the catalogue up to each size in turn. Views go through Django's test client and
+websocket actions straight into PartyConsumers, whose database writes are then applied by PartyPersistConsumer and
+counted separately. The templates need the frontend built (webpack-stats.json).
+
+Each case's query counts are checked against benchmarks/budgets.json, and must not grow with the catalogue. Given an
+earlier run's results, median times and peak allocations are checked against those too. It exits non-zero if
+anything fails:
+
+    $ python benchmarks/suite.py --output before.json
+    $ git checkout my-branch
+    $ python benchmarks/suite.py --baseline before.json --threshold 1.25
+
+--record rewrites budgets.json from this run's counts instead.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from importlib import import_module
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ponytone.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.exceptions import StopConsumer  # noqa: E402
+from channels.layers import InMemoryChannelLayer  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.db.backends.utils import CursorWrapper  # noqa: E402
+from django.test import Client  # noqa: E402
+
+from common import percentile, run_metadata  # noqa: E402
+from karaoke import tracklist  # noqa: E402
+from karaoke.consumer import PartyConsumer, PartyPersistConsumer  # noqa: E402
+from karaoke.models import Song  # noqa: E402
+from karaoke.redis_conn import get_redis  # noqa: E402
+from karaoke.views import allocate_party  # noqa: E402
+
+BUDGETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'budgets.json')
+# Differences smaller than these are noise, whatever the ratio.
+NOISE_MS = 0.2
+NOISE_BYTES = 16 * 1024
+# Rebuilding the track list takes about a minute at 100k songs, most of it in brotli.
+ITERATIONS = {'track_listing_rebuild': 3}
+WORDS = ["love", "friendship", "magic", "pony", "rainbow", "smile", "winter", "wrap", "up", "song", "day", "night",
+         "apple", "cider", "sky", "dream", "heart", "star", "light", "party"]
+
+# asyncio.all_tasks and asyncio.current_task are 3.7+.
+all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+class QueryCounter:
+    """Counts queries on every thread's connection.
+
+    CaptureQueriesContext only sees this thread's, but consumers query from sync_to_async's worker threads.
+    """
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        CursorWrapper.execute = self._counted(CursorWrapper.execute)
+        CursorWrapper.executemany = self._counted(CursorWrapper.executemany)
+
+    def _counted(self, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with self._lock:
+                self.count += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+
+class Layer(InMemoryChannelLayer):
+    """Keeps party.persist messages for the suite to apply, and delivers frames straight to the consumers here."""
+    def __init__(self):
+        super().__init__()
+        self.persisted = []
+        self.sockets = {}
+
+    async def send(self, channel, message):
+        if channel == 'party.persist':
+            self.persisted.append(message)
+        elif channel in self.sockets:
+            await self.sockets[channel].dispatch(message)
+
+
+class Sample:
+    def __init__(self, traced):
+        self.traced = traced
+        self.seconds = None
+        self.queries = None
+        self.persist_queries = None
+        self.peak_bytes = None
+
+
+class Timed:
+    """Measures the body of an `async with`, then waits for anything the consumers left running in the background
+    (playlist broadcasts, member expiry) and applies the database writes they asked for."""
+    def __init__(self, bench, sample):
+        self.bench = bench
+        self.sample = sample
+
+    async def __aenter__(self):
+        # Whatever setting up the case persisted isn't part of it.
+        self.bench.apply_persisted()
+        if self.sample.traced:
+            tracemalloc.start()
+        self.queries = self.bench.counter.count
+        self.start = time.perf_counter()
+
+    async def __aexit__(self, *exc):
+        await settle()
+        self.sample.seconds = time.perf_counter() - self.start
+        self.sample.queries = self.bench.counter.count - self.queries
+        if self.sample.traced:
+            self.sample.peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        before = self.bench.counter.count
+        self.bench.apply_persisted()
+        self.sample.persist_queries = self.bench.counter.count - before
+
+
+async def settle():
+    current = current_task()
+    while True:
+        pending = [x for x in all_tasks() if x is not current and not x.done()]
+        if not pending:
+            return
+        await asyncio.wait(pending)
+
+
+class Bench:
+    def __init__(self, iterations, members):
+        self.iterations = iterations
+        self.members = members
+        self.counter = QueryCounter()
+        self.layer = Layer()
+        self.worker = PartyPersistConsumer({'type': 'channel'})
+        self.client = Client()
+        self.session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        self.sample = None
+
+    def timed(self):
+        return Timed(self, self.sample)
+
+    def apply_persisted(self):
+        persisted, self.layer.persisted = self.layer.persisted, []
+        for message in persisted:
+            getattr(self.worker, message['type'].replace('.', '_'))(message)
+
+    async def run(self, case, iterations):
+        # Once to warm up, then measured, then once more for allocations: tracing makes everything else slower.
+        self.sample = Sample(traced=False)
+        await case()
+        samples = []
+        for i in range(iterations + 1):
+            self.sample = Sample(traced=i == iterations)
+            await case()
+            samples.append(self.sample)
+        times = sorted(x.seconds * 1000 for x in samples[:-1])
+        return {
+            'median_ms': statistics.median(times),
+            'p95_ms': percentile(times, 0.95),
+            'peak_alloc_bytes': samples[-1].peak_bytes,
+            'queries': max(x.queries for x in samples),
+            'persist_queries': max(x.persist_queries for x in samples),
+        }
+
+    def new_session(self, party_id):
+        session = self.session_store()
+        session['party_id'] = party_id
+        session.create()
+        return session.session_key
+
+    async def open(self, party_id, session_key=None, nick=None):
+        consumer = PartyConsumer({
+            'type': 'websocket',
+            'path': f'/karaoke/party/{party_id}',
+            'headers': [],
+            'session': self.session_store(session_key or self.new_session(party_id)),
+            'url_route': {'args': (), 'kwargs': {'party_id': party_id}},
+        })
+        consumer.channel_layer = self.layer
+        consumer.channel_name = await self.layer.new_channel()
+
+        async def send(message):
+            pass
+        consumer.base_send = send
+        self.layer.sockets[consumer.channel_name] = consumer
+        await consumer.websocket_connect({'type': 'websocket.connect'})
+        if nick:
+            await self.frame(consumer, action='hello', nick=nick)
+        return consumer
+
+    async def close(self, consumer):
+        try:
+            await consumer.websocket_disconnect({'type': 'websocket.disconnect', 'code': 1000})
+        except StopConsumer:
+            pass
+        del self.layer.sockets[consumer.channel_name]
+
+    async def frame(self, consumer, **content):
+        await consumer.websocket_receive({'type': 'websocket.receive', 'text': json.dumps(content)})
+
+
+def seed(size):
+    """Adds songs until there are size of them, and publishes the new track list."""
+    have = Song.objects.count()
+    rng = random.Random(have)
+    Song.objects.bulk_create([Song(
+        title=' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title(),
+        artist=' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 2))).title(),
+        genre='Pop',
+        language='English',
+        length=rng.randint(60, 300),
+        cover_image='cover.jpg',
+        parts=['Twilight', 'Pinkie'] if rng.random() < 0.1 else None,
+        notes=f'notes.{rng.getrandbits(64):016x}.json',
+        preview=f'preview.{rng.getrandbits(64):016x}.mp3',
+        replay_gain=rng.uniform(-12, 0),
+    ) for _ in range(size - have)], batch_size=5000)
+    tracklist.publish()
+
+
+async def view(bench, method, path, **headers):
+    async with bench.timed():
+        response = getattr(bench.client, method)(path, **headers)
+    assert response.status_code < 400, (path, response.status_code)
+
+
+async def track_listing_rebuild(bench):
+    tracklist.invalidate()
+    async with bench.timed():
+        response = bench.client.get('/tracklist', HTTP_ACCEPT_ENCODING='br')
+    assert response.status_code == 200
+
+
+async def connect(bench):
+    party_id = allocate_party()
+    session_key = bench.new_session(party_id)
+    async with bench.timed():
+        consumer = await bench.open(party_id, session_key)
+    await bench.close(consumer)
+
+
+async def hello(bench):
+    consumer = await bench.open(allocate_party())
+    async with bench.timed():
+        await bench.frame(consumer, action='hello', nick='Twilight')
+    await bench.close(consumer)
+
+
+async def disconnect(bench):
+    consumer = await bench.open(allocate_party(), nick='Twilight')
+    async with bench.timed():
+        await bench.close(consumer)
+
+
+class Party:
+    """A party with a few members and a queue, for the actions that don't change who's in it."""
+    def __init__(self, bench, songs):
+        self.bench = bench
+        self.songs = iter(songs)
+        self.id = None
+        self.members = []
+
+    async def start(self):
+        self.id = allocate_party()
+        for i in range(self.bench.members):
+            self.members.append(await self.bench.open(self.id, nick=f'Pony {i}'))
+        for _ in range(10):
+            await self.bench.frame(self.host, action='addToQueue', song=next(self.songs))
+
+    @property
+    def host(self):
+        return self.members[0]
+
+    def playlist(self):
+        return self.host.state.playlist()[1]
+
+    async def act(self, action, **content):
+        async with self.bench.timed():
+            await self.bench.frame(self.host, action=action, **content)
+
+    async def add_to_queue(self):
+        await self.act('addToQueue', song=next(self.songs))
+
+    async def move_in_queue(self):
+        await self.act('moveInQueue', song=self.playlist()[-1], direction='front')
+
+    async def remove_from_queue(self):
+        await self.bench.frame(self.host, action='addToQueue', song=next(self.songs))
+        await self.act('removeFromQueue', song=self.playlist()[-1])
+
+    async def pop_queue(self):
+        await self.bench.frame(self.host, action='addToQueue', song=next(self.songs))
+        await self.act('popQueue')
+
+    async def relay(self):
+        await self.act('relay', target=self.members[-1].channel_name, message={'type': 'offer', 'sdp': 'v=0 ' * 500})
+
+
+def cases(bench, party):
+    yield 'index', functools.partial(view, bench, 'get', '/')
+    yield 'party', functools.partial(view, bench, 'get', f'/{party.id}')
+    yield 'create_party', functools.partial(view, bench, 'post', '/party/create')
+    yield 'ntp', functools.partial(view, bench, 'get', f'/ntp?t={int(time.time() * 1000)}')
+    yield 'track_listing', functools.partial(view, bench, 'get', '/tracklist', HTTP_ACCEPT_ENCODING='br')
+    yield 'track_listing_not_modified', functools.partial(
+        view, bench, 'get', '/tracklist', HTTP_ACCEPT_ENCODING='br',
+        HTTP_IF_NONE_MATCH=f'"{tracklist.current().version}-br"')
+    yield 'track_listing_rebuild', functools.partial(track_listing_rebuild, bench)
+    yield 'song_search', functools.partial(view, bench, 'get', '/tracklist/search?q=pony&limit=50')
+    yield 'ws_connect', functools.partial(connect, bench)
+    yield 'ws_hello', functools.partial(hello, bench)
+    yield 'ws_heartbeat', functools.partial(party.act, 'heartbeat')
+    yield 'ws_relay', party.relay
+    yield 'ws_add_to_queue', party.add_to_queue
+    yield 'ws_move_in_queue', party.move_in_queue
+    yield 'ws_remove_from_queue', party.remove_from_queue
+    yield 'ws_pop_queue', party.pop_queue
+    yield 'ws_get_playlist', functools.partial(party.act, 'getPlaylist')
+    yield 'ws_disconnect', functools.partial(disconnect, bench)
+
+
+async def measure(bench, size):
+    songs = list(Song.objects.order_by('?').values_list('id', flat=True)[:10 + (bench.iterations + 1) * 3 + 3])
+    party = Party(bench, songs)
+    await party.start()
+    results = {}
+    for name, case in cases(bench, party):
+        results[name] = await bench.run(case, min(bench.iterations, ITERATIONS.get(name, bench.iterations)))
+        print(f"  {size:>7} {name:<28} {results[name]['median_ms']:8.2f}ms "
+              f"{results[name]['peak_alloc_bytes'] / 1024:9.1f}KiB {results[name]['queries']:3} queries "
+              f"(+{results[name]['persist_queries']} persisted)")
+    for consumer in party.members:
+        await bench.close(consumer)
+    await settle()
+    return results
+
+
+def check(results, budgets, baseline, threshold):
+    failures = []
+    for name in results[next(iter(results))]:
+        by_size = {size: cases[name] for size, cases in results.items()}
+        for key in ('queries', 'persist_queries'):
+            counts = {size: x[key] for size, x in by_size.items()}
+            if len(set(counts.values())) > 1:
+                failures.append(f"{name}: {key} grows with the catalogue: {counts}")
+            budget = budgets.get(name, {}).get(key)
+            if budget is None:
+                failures.append(f"{name}: no {key} budget (see --record)")
+            elif max(counts.values()) > budget:
+                failures.append(f"{name}: {max(counts.values())} {key}, over its budget of {budget}")
+        for size, x in by_size.items():
+            old = (baseline or {}).get(str(size), {}).get(name)
+            if old is None:
+                continue
+            for key, noise in (('median_ms', NOISE_MS), ('peak_alloc_bytes', NOISE_BYTES)):
+                if x[key] > old[key] * threshold and x[key] - old[key] > noise:
+                    failures.append(f"{name} at {size} songs: {key} {x[key]:.1f}, was {old[key]:.1f}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--members', type=int, default=6, help="Members in the party the queue actions run in")
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15',
+                        help="A Redis database to use, which is flushed before and after")
+    parser.add_argument('--baseline', help="Results of an earlier run to check for regressions against")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="How many times slower or bigger than the baseline a case may be")
+    parser.add_argument('--record', action='store_true', help="Write this run's query counts to budgets.json")
+    parser.add_argument('--output', default='suite.json')
+    args = parser.parse_args()
+
+    settings.REDIS_URL = args.redis_url
+    settings.REDIS_SHARD_URLS = []
+    settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['testserver']
+    # Run broadcasts and member expiry straight away, so they're counted with the action that caused them.
+    settings.PLAYLIST_BROADCAST_WINDOW = 0
+    settings.PARTY_RESUME_GRACE = 0
+    # Consumers' worker threads should let go of the test database once they're done with it.
+    settings.DATABASES['default']['CONN_MAX_AGE'] = 0
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    get_redis().flushdb()
+    bench = Bench(args.iterations, args.members)
+    loop = asyncio.get_event_loop()
+    results = {}
+    try:
+        for size in sorted(args.sizes):
+            print(f"Seeding {size} songs")
+            seed(size)
+            results[size] = loop.run_until_complete(measure(bench, size))
+    finally:
+        get_redis().flushdb()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.record:
+        budgets = {name: {key: max(cases[name][key] for cases in results.values())
+                          for key in ('queries', 'persist_queries')}
+                   for name in results[next(iter(results))]}
+        with open(BUDGETS, 'w') as f:
+            json.dump(budgets, f, indent=2)
+            f.write('\n')
+    with open(BUDGETS) as f:
+        budgets = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    failures = check(results, budgets, baseline, args.threshold)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            **run_metadata(args, exclude=('output', 'baseline', 'record')),
+            'results': {str(size): cases for size, cases in results.items()},
+            'failures': failures,
+        }, f, indent=2)
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Measures how fast UltraStar headers are read, against the old detect-and-decode-everything approach.
+
+Runs over every .txt file under the given directories, or over a generated corpus of mixed encodings if none are
+given, and writes the results as JSON so runs can be compared across commits:
+
+    $ python benchmarks/ultrastar_headers.py ~/songs --output headers.json
+"""
+import argparse
+import codecs
+import json
+import os
+import random
+import sys
+import time
+
+import chardet
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import run_metadata  # noqa: E402
+from karaoke import ultrastar  # noqa: E402
+
+
+def full_decode(content):
+    # What importmlk.py did before read_header() existed.
+    decoded = content.decode(chardet.detect(content)['encoding'])
+    fields = {}
+    for line in decoded.split('\n'):
+        line = line.strip()
+        if len(line) > 1 and line[0] == '#' and ':' in line:
+            k, v = line.split(':', 1)
+            fields[k[1:]] = v
+    return fields
+
+
+def generate(count):
+    words = ["la", "love", "friendship", "magic", "pony", "café", "über", "señor", "naïve", "rêve"]
+    corpus = []
+    for i in range(count):
+        header = (f"#TITLE:Song {i} {random.choice(words)}\n#ARTIST:Artist {i}\n#MP3:song.mp3\n#COVER:cover.jpg\n"
+                  f"#BPM:{random.randint(100, 400)},5\n#GAP:{random.randint(0, 20000)}\n#LANGUAGE:English\n")
+        body = "".join(f": {j * 4} 2 {j % 12} {random.choice(words)}\n" + ("- %d\n" % (j * 4 + 3) if j % 8 == 7 else "")
+                       for j in range(random.randint(300, 1500))) + "E\n"
+        kind = i % 4
+        if kind == 0:
+            corpus.append((header + body).encode('utf-8'))
+        elif kind == 1:
+            corpus.append(codecs.BOM_UTF8 + (header + body).encode('utf-8'))
+        elif kind == 2:
+            corpus.append((header + body).encode('cp1252'))
+        else:
+            corpus.append(("#ENCODING:CP1252\n" + header + body).encode('cp1252'))
+    return corpus
+
+
+def load(directories):
+    corpus = []
+    for directory in directories:
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.endswith('.txt'):
+                    with open(os.path.join(dirpath, filename), 'rb') as f:
+                        corpus.append(f.read())
+    return corpus
+
+
+def measure(function, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in corpus:
+            function(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    size = sum(len(x) for x in corpus)
+    return {'seconds': best, 'files_per_second': len(corpus) / best, 'mb_per_second': size / best / 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directories', nargs='*', help="Directories of UltraStar files")
+    parser.add_argument('--generate', type=int, default=400, help="Size of the generated corpus")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='ultrastar_headers.json')
+    args = parser.parse_args()
+
+    random.seed(0)
+    corpus = load(args.directories) if args.directories else generate(args.generate)
+    mismatches = sum(1 for x in corpus if ultrastar.read_header(x) != (full_decode(x) or None))
+
+    result = {
+        **run_metadata(args),
+        'files': len(corpus),
+        'bytes': sum(len(x) for x in corpus),
+        'mismatches': mismatches,
+        'read_header': measure(ultrastar.read_header, corpus, args.repeat),
+        'full_decode': measure(full_decode, corpus, args.repeat),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    # Differences are usually chardet guessing a neighbouring code page for short runs of accented text.
+    print(f"{result['files']} files, {result['bytes'] / 1e6:.1f} MB, {mismatches} headers differ from full decoding")
+    for name in ('read_header', 'full_decode'):
+        print(f"  {name:12} {result[name]['files_per_second']:9.0f} files/s {result[name]['mb_per_second']:8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
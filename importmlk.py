@@ -1,19 +1,52 @@
 #!/usr/bin/env python
+"""Imports an MLK-style song archive: uploads each song's files to S3 and records it in the database.
+
+    $ python importmlk.py https://example.com/pack.tar.gz postgres://localhost/ponytone
+
+The archive is streamed straight into a scratch directory while it downloads. Song headers are then parsed in a
+process pool, assets are uploaded from a thread pool, and rows are inserted in batches once their uploads succeed.
+
+Every song directory is fingerprinted by the hashes of its files, and the karaoke_importedsong table records what was
+last imported from each one. Re-running an import skips unchanged songs, re-uploads only the files that changed, and
+updates existing songs in place, so it is safe to run again after a crash or on a refreshed pack.
+
+With --bulk, nothing is written to the database until every upload is done; all the rows are then COPYed into
+staging tables and merged in one transaction. That's much faster for rebuilding a whole catalogue, but a crash
+part-way through means uploading everything again.
+Pass --endpoint-url to upload to an S3 stand-in such as MinIO or moto_server, or --media local --media-root DIR to
+write the files into a directory instead, for the server to serve itself (see MUSIC_ROOT and karaoke.asgi.MediaFiles).
+
+Alongside each song's own files, the importer uploads compiled notes (see karaoke.ultrastar) and a short preview clip
+cut from the MP3 (see karaoke.audio), and records the MP3's bitrate, sample rate, length and ReplayGain.
+"""
+import argparse
+import hashlib
+import io
+import json
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import os
+import shutil
+import subprocess
 import sys
 import tarfile
 import tempfile
+import time
 import mimetypes
 
 import boto3
-import chardet
+import boto3.s3.transfer
 import dateutil.parser
-import mutagen.mp3
+import mutagen
 import psycopg2
 import psycopg2.extras
 import requests
 
+from karaoke import audio, ultrastar
+
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+DB_BATCH_SIZE = 100
+TRANSFER_CONFIG = boto3.s3.transfer.TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=4)
 
 # Hackery to deal with strange MLK dates.
 class MLKDateParserInfo(dateutil.parser.parserinfo):
@@ -33,30 +66,25 @@ class MLKDateParserInfo(dateutil.parser.parserinfo):
     ]
 
 
-def parse(content: bytes):
-    encoding = chardet.detect(content)
-    decoded = content.decode(encoding['encoding'])
-    fields = {}
-    for line in decoded.split('\n'):
-        line = line.strip()
-        if len(line) <= 1:
-            continue
-        if line[0] == '#':
-            try:
-                k, v = line.split(':', 1)
-            except ValueError:
-                print(f"Bad line {line} in {filename}")
-            else:
-                fields[k[1:]] = v
-    return fields or None
-
 SongInfo = namedtuple("SongInfo", "title artist genre song_year length language transcriber is_mlk updated notes mp3 "
-                                  "background video preview_start parts cover")
+                                  "background video preview_start parts cover compiled_notes bitrate sample_rate "
+                                  "audio_length replay_gain preview")
 
 
-def song_info(tar: tarfile.TarFile, path: str):
-    content = tar.extractfile(path)
-    parsed = parse(content.read())
+def asset_path(root: str, path: str, name: str):
+    """Returns the real path of the asset the song at path calls name, or None if that isn't inside its directory."""
+    dirname = os.path.realpath(os.path.join(root, os.path.dirname(path)))
+    resolved = os.path.realpath(os.path.join(dirname, name))
+    # The name is also the song's key in the bucket, so it mustn't climb out of the song's directory there either.
+    if os.path.isabs(name) or '..' in name.replace('\\', '/').split('/') or not resolved.startswith(dirname + os.sep):
+        return None
+    return resolved
+
+
+def song_info(root: str, path: str):
+    with open(os.path.join(root, path), 'rb') as f:
+        content = f.read()
+    parsed = ultrastar.read_header(content, path)
     if parsed is None:
         return None
     artist = parsed.get('ARTIST')
@@ -71,15 +99,24 @@ def song_info(tar: tarfile.TarFile, path: str):
     except ValueError:
         print(f"Couldn't parse date: {parsed['UPDATED']}")
         updated = None
-    mp3_path = os.path.join(os.path.dirname(path), parsed['MP3'])
-    try:
-        tar.getmember(mp3_path)
-    except KeyError:
+    for field in ('MP3', 'COVER', 'BACKGROUND', 'VIDEO'):
+        if field in parsed and asset_path(root, path, parsed[field]) is None:
+            print(f"Skipping {path}: #{field} points outside the song's directory")
+            return None
+    mp3_path = asset_path(root, path, parsed['MP3'])
+    if not os.path.isfile(mp3_path):
         return None
+    try:
+        audio_info = audio.audio_info(mp3_path)
+    except mutagen.MutagenError as e:
+        print(f"Couldn't read {mp3_path}: {e!r}")
+        audio_info = audio.AudioInfo(None, None, None, None)
     if 'END' in parsed:
         duration = int(parsed['END']) / 1000
+    elif audio_info.duration is not None:
+        duration = audio_info.duration
     else:
-        duration = mutagen.mp3.MP3(tar.extractfile(mp3_path)).info.length
+        return None
     if 'START' in parsed:
         duration -= float(parsed['START'].replace(',', '.'))
     is_mlk = 'mylittlekaraoke' in parsed.get('COMMENT', '')
@@ -92,65 +129,302 @@ def song_info(tar: tarfile.TarFile, path: str):
         parts = None
 
     preview_start = float(parsed['PREVIEWSTART'].replace(',', '.')) if 'PREVIEWSTART' in parsed else None
+
+    # Generated files are written next to the song so they're uploaded (and fingerprinted) like any other asset.
+    compiled = ultrastar.dumps(ultrastar.compile_notes(ultrastar.decode(content)))
+    compiled_notes = write_generated(root, path, ultrastar.compiled_name(compiled), compiled)
+
+    with open(mp3_path, 'rb') as f:
+        clip_start = preview_start
+        if clip_start is None:
+            clip_start = max(0, min(audio.DEFAULT_PREVIEW_START, duration - audio.PREVIEW_SECONDS))
+        clip = audio.preview_clip(f.read(), clip_start)
+    preview = write_generated(root, path, audio.preview_name(clip), clip) if clip else None
+
     return SongInfo(title, artist, genre, song_year, duration, language, transcriber, is_mlk, updated, path, mp3,
-                    background, video, preview_start, parts, cover)
-
-
-def store_song(connection, tar: tarfile.TarFile, song: SongInfo):
-    client = boto3.client('s3')
-    opts = {'ACL': 'public-read', 'Bucket': 'music.ponytone.online'}
-    with connection:
-        with connection.cursor() as cur:
-            stuff = song._asdict()
-            if song.parts:
-                stuff['parts'] = song.parts
-            q = cur.execute("""
-                INSERT INTO karaoke_song (title, artist, transcriber, genre, updated, "language", "length",
-                                          preview_start, song_year, is_mlk, cover_image, parts)
-                VALUES (%(title)s, %(artist)s, %(transcriber)s, %(genre)s, %(updated)s, %(language)s, %(length)s,
-                        %(preview_start)s, %(song_year)s, %(is_mlk)s, %(cover)s, %(parts)s)
-                RETURNING id""", stuff)
-            id, = cur.fetchone()
-            print(f"Inserted into DB: #{id}")
-
-            dirname = os.path.dirname(song.notes)
-            f = tar.extractfile(song.notes)
-            client.put_object(Body=f, Key=f"{id}/notes.txt", ContentType="text/plain", **opts)
-            f = tar.extractfile(os.path.join(dirname, song.mp3))
-            print("Uploaded MP3")
-            client.put_object(Body=f, Key=f"{id}/{song.mp3}", ContentType="audio/mpeg", **opts)
-            f = tar.extractfile(os.path.join(dirname, song.cover))
-            print("Uploaded cover")
-            client.put_object(Body=f, Key=f"{id}/{song.cover}",
-                              ContentType=mimetypes.guess_type(song.cover)[0], **opts)
-            if song.background:
-                f = tar.extractfile(os.path.join(dirname, song.background))
-                client.put_object(Body=f, Key=f"{id}/{song.background}",
-                                  ContentType=mimetypes.guess_type(song.background)[0], **opts)
-                print("Uploaded background")
-            if song.video:
-                f = tar.extractfile(os.path.join(dirname, song.video))
-                client.put_object(Body=f, Key=f"{id}/{song.video}",
-                                  ContentType=mimetypes.guess_type(song.video)[0], **opts)
-                print("Uploaded video")
-    print("Committed")
+                    background, video, preview_start, parts, cover, compiled_notes, audio_info.bitrate,
+                    audio_info.sample_rate, audio_info.duration, audio_info.replay_gain, preview)
 
 
-if __name__ == "__main__":
-    url = sys.argv[1]
-    connection = psycopg2.connect(sys.argv[2])
-
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with tempfile.TemporaryFile() as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-            f.seek(0)
-            tar = tarfile.open(fileobj=f)
-            filenames = tar.getnames()
-            for filename in filenames:
-                if not filename.endswith(".txt"):
+def write_generated(root: str, path: str, filename: str, content: bytes):
+    with open(os.path.join(root, os.path.dirname(path), filename), 'wb') as f:
+        f.write(content)
+    return filename
+
+
+def hash_file(path: str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(assets: dict):
+    return hashlib.sha256(json.dumps(assets, sort_keys=True).encode()).hexdigest()
+
+
+def _song_info(args):
+    """Returns (path, SongInfo, {key: hash}) for a notes file, or (path, None, None) if it can't be imported."""
+    root, path = args
+    try:
+        song = song_info(root, path)
+        if song is None:
+            return path, None, None
+        dirname = os.path.join(root, os.path.dirname(path))
+        return path, song, {key: hash_file(os.path.join(dirname, filename)) for filename, key, _ in song_assets(song)}
+    except Exception as e:
+        print(f"Couldn't parse {path}: {e!r}")
+        return path, None, None
+
+
+def download(url: str, root: str):
+    """Streams the archive at url (or a local path) into root, extracting as it arrives."""
+    if os.path.exists(url):
+        source = open(url, 'rb')
+    else:
+        response = requests.get(url, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        source = response.raw
+    with source, tarfile.open(fileobj=source, mode='r|*', bufsize=DOWNLOAD_CHUNK_SIZE) as tar:
+        for member in tar:
+            if not (member.isfile() or member.isdir()) or member.name.startswith('/') or '..' in member.name.split('/'):
+                continue
+            tar.extract(member, root, set_attrs=False)
+
+
+def song_assets(song: SongInfo):
+    """Yields (filename, key, content type) for each file a song needs uploaded."""
+    yield os.path.basename(song.notes), "notes.txt", "text/plain"
+    yield song.compiled_notes, song.compiled_notes, "application/json"
+    if song.preview:
+        yield song.preview, song.preview, "audio/mpeg"
+    yield song.mp3, song.mp3, "audio/mpeg"
+    for asset in (song.cover, song.background, song.video):
+        if asset:
+            yield asset, asset, mimetypes.guess_type(asset)[0]
+
+
+class S3Media:
+    def __init__(self, bucket: str, endpoint_url: str = None):
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.bucket = bucket
+
+    def put(self, path: str, key: str, content_type: str, immutable: bool):
+        extra = {'ACL': 'public-read', 'ContentType': content_type or 'application/octet-stream'}
+        if immutable:
+            extra['CacheControl'] = 'public, max-age=31536000, immutable'
+        self.client.upload_file(path, self.bucket, key, Config=TRANSFER_CONFIG, ExtraArgs=extra)
+
+
+class LocalMedia:
+    """Writes files under root, laid out as in the bucket. Content types and caching are up to whoever serves them."""
+    def __init__(self, root: str):
+        self.root = os.path.realpath(root)
+
+    def put(self, path: str, key: str, content_type: str, immutable: bool):
+        destination = os.path.realpath(os.path.join(self.root, key))
+        if not destination.startswith(self.root + os.sep):
+            raise ValueError(f"{key} is outside the media root")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        # Copy then rename, so nobody is ever served half a file.
+        partial = f"{destination}.partial"
+        shutil.copyfile(path, partial)
+        os.replace(partial, destination)
+
+
+def upload_song(media, root: str, id: int, song: SongInfo, assets: dict, previous: dict):
+    """Uploads the song's files whose hashes differ from the previous import's."""
+    dirname = os.path.join(root, os.path.dirname(song.notes))
+    uploaded = 0
+    for filename, key, content_type in song_assets(song):
+        if previous.get(key) == assets[key]:
+            continue
+        path = os.path.join(dirname, filename)
+        media.put(path, f"{id}/{key}", content_type, key in (song.compiled_notes, song.preview))
+        uploaded += os.path.getsize(path)
+    return uploaded
+
+
+def reserve_ids(connection, count: int):
+    with connection, connection.cursor() as cur:
+        cur.execute("SELECT nextval(pg_get_serial_sequence('karaoke_song', 'id')) FROM generate_series(1, %s)",
+                    (count,))
+        return [x for x, in cur.fetchall()]
+
+
+def load_manifest(connection):
+    """Returns {path: (song id, fingerprint, {key: hash})} for everything imported so far."""
+    with connection, connection.cursor() as cur:
+        cur.execute("SELECT path, song_id, fingerprint, assets FROM karaoke_importedsong")
+        return {path: (id, fingerprint, assets) for path, id, fingerprint, assets in cur}
+
+
+SONG_COLUMNS = ('id', 'title', 'artist', 'transcriber', 'genre', 'updated', 'language', 'length', 'preview_start',
+                'song_year', 'is_mlk', 'cover_image', 'parts', 'notes', 'bitrate', 'sample_rate', 'audio_length',
+                'replay_gain', 'preview')
+MANIFEST_COLUMNS = ('path', 'song_id', 'fingerprint', 'assets')
+
+SONG_UPSERT = "ON CONFLICT (id) DO UPDATE SET " + ", ".join(f'"{x}" = EXCLUDED."{x}"' for x in SONG_COLUMNS[1:])
+MANIFEST_UPSERT = ("ON CONFLICT (path) DO UPDATE SET song_id = EXCLUDED.song_id, fingerprint = EXCLUDED.fingerprint, "
+                   "assets = EXCLUDED.assets, imported = EXCLUDED.imported")
+
+
+def song_row(id: int, song: SongInfo):
+    return (id, song.title, song.artist, song.transcriber, song.genre, song.updated, song.language, song.length,
+            song.preview_start, song.song_year, song.is_mlk, song.cover, song.parts, song.compiled_notes, song.bitrate,
+            song.sample_rate, song.audio_length, song.replay_gain, song.preview)
+
+
+def _columns(columns):
+    return ", ".join(f'"{x}"' for x in columns)
+
+
+def store_songs(connection, songs):
+    """Inserts or updates [(id, SongInfo, {key: hash})], along with their manifest entries, in one transaction."""
+    with connection, connection.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur, f"INSERT INTO karaoke_song ({_columns(SONG_COLUMNS)}) VALUES %s {SONG_UPSERT}",
+            [song_row(id, song) for id, song, _ in songs])
+        psycopg2.extras.execute_values(
+            cur,
+            f"INSERT INTO karaoke_importedsong ({_columns(MANIFEST_COLUMNS)}, imported) VALUES %s {MANIFEST_UPSERT}",
+            [(song.notes, id, fingerprint(assets), psycopg2.extras.Json(assets)) for id, song, assets in songs],
+            template="(%s, %s, %s, %s, now())")
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, list):
+        value = '{' + ','.join('"' + x.replace('\\', '\\\\').replace('"', '\\"') + '"' for x in value) + '}'
+    elif isinstance(value, dict):
+        value = json.dumps(value)
+    elif hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy(cur, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(x) for x in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({_columns(columns)}) FROM STDIN", buffer)
+
+
+def bulk_store_songs(connection, songs):
+    """Like store_songs, but COPYs everything into staging tables and merges it with one statement per table.
+
+    Meant for loading a whole catalogue at once, where row-at-a-time inserts and their index updates dominate.
+    """
+    with connection, connection.cursor() as cur:
+        cur.execute("CREATE TEMPORARY TABLE import_song (LIKE karaoke_song) ON COMMIT DROP")
+        # Lengths arrive in fractional seconds; let the merge round them the same way store_songs' INSERT does.
+        cur.execute("ALTER TABLE import_song ALTER length TYPE numeric, ALTER preview_start TYPE numeric")
+        cur.execute("CREATE TEMPORARY TABLE import_manifest "
+                    "(path varchar(500), song_id integer, fingerprint varchar(64), assets jsonb) ON COMMIT DROP")
+        _copy(cur, "import_song", SONG_COLUMNS, (song_row(id, song) for id, song, _ in songs))
+        _copy(cur, "import_manifest", MANIFEST_COLUMNS,
+              ((song.notes, id, fingerprint(assets), assets) for id, song, assets in songs))
+        cur.execute(f"INSERT INTO karaoke_song ({_columns(SONG_COLUMNS)}) "
+                    f"SELECT {_columns(SONG_COLUMNS)} FROM import_song {SONG_UPSERT}")
+        cur.execute(f"INSERT INTO karaoke_importedsong ({_columns(MANIFEST_COLUMNS)}, imported) "
+                    f"SELECT {_columns(MANIFEST_COLUMNS)}, now() FROM import_manifest {MANIFEST_UPSERT}")
+        cur.execute("ANALYZE karaoke_song")
+
+
+def import_archive(args):
+    connection = psycopg2.connect(args.database)
+    if args.media == 'local':
+        media = LocalMedia(args.media_root)
+    else:
+        media = S3Media(args.bucket, args.endpoint_url)
+    start = time.time()
+    stats = {'found': 0, 'parsed': 0, 'unchanged': 0, 'stored': 0, 'failed': 0, 'bytes': 0}
+
+    with tempfile.TemporaryDirectory() as root:
+        download(args.url, root)
+        downloaded = time.time()
+        print(f"Downloaded and extracted in {downloaded - start:.1f}s")
+
+        paths = []
+        for dirpath, _, filenames in os.walk(root):
+            paths.extend(os.path.relpath(os.path.join(dirpath, x), root) for x in filenames if x.endswith(".txt"))
+        stats['found'] = len(paths)
+
+        with ProcessPoolExecutor(args.parse_workers) as pool:
+            parsed = [(song, assets) for _, song, assets in pool.map(_song_info, ((root, x) for x in paths),
+                                                                    chunksize=16) if song]
+        stats['parsed'] = len(parsed)
+
+        manifest = load_manifest(connection)
+        changed, new = [], []
+        for song, assets in parsed:
+            if song.notes not in manifest:
+                new.append((song, assets))
+                continue
+            id, previous_fingerprint, previous = manifest[song.notes]
+            if previous_fingerprint == fingerprint(assets):
+                stats['unchanged'] += 1
+            else:
+                changed.append((id, song, assets, previous))
+        # Ids are only handed out to songs we haven't seen, so a rerun after a crash reuses everything it stored.
+        changed.extend((id, song, assets, {}) for id, (song, assets) in zip(reserve_ids(connection, len(new)), new))
+
+        pending = []
+        with ThreadPoolExecutor(args.upload_threads) as pool:
+            futures = {pool.submit(upload_song, media, root, id, song, assets, previous):
+                       (id, song, assets) for id, song, assets, previous in changed}
+            for future in as_completed(futures):
+                id, song, assets = futures[future]
+                try:
+                    stats['bytes'] += future.result()
+                except Exception as e:
+                    print(f"Failed to upload {song.notes}: {e!r}")
+                    stats['failed'] += 1
                     continue
-                info = song_info(tar, filename)
-                store_song(connection, tar, info)
+                pending.append((id, song, assets))
+                if not args.bulk and len(pending) >= DB_BATCH_SIZE:
+                    store_songs(connection, pending)
+                    stats['stored'] += len(pending)
+                    pending = []
+            if pending:
+                (bulk_store_songs if args.bulk else store_songs)(connection, pending)
+                stats['stored'] += len(pending)
+
+    elapsed = time.time() - start
+    print(f"Found {stats['found']} songs, parsed {stats['parsed']}, {stats['unchanged']} unchanged, "
+          f"stored {stats['stored']}, failed {stats['failed']}.")
+    print(f"Uploaded {stats['bytes'] / 1e6:.1f} MB in {elapsed - (downloaded - start):.1f}s; "
+          f"{stats['stored'] / elapsed:.1f} songs/s overall, {elapsed:.1f}s total.")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Imports an MLK-style song archive.")
+    parser.add_argument('url', help="URL or local path of the archive")
+    parser.add_argument('database', help="PostgreSQL connection string")
+    parser.add_argument('--media', choices=('s3', 'local'), default='s3', help="Where to put song files")
+    parser.add_argument('--media-root', default=os.environ.get('MUSIC_ROOT'),
+                        help="Directory to write song files to with --media local")
+    parser.add_argument('--bucket', default='music.ponytone.online')
+    parser.add_argument('--endpoint-url', default=os.environ.get('S3_ENDPOINT_URL'),
+                        help="S3 endpoint, for MinIO or another stand-in")
+    parser.add_argument('--parse-workers', type=int, default=None)
+    parser.add_argument('--upload-threads', type=int, default=16)
+    parser.add_argument('--bulk', action='store_true',
+                        help="Store every song in one COPY and merge at the end, for loading a whole catalogue")
+    args = parser.parse_args()
+    if args.media == 'local' and not args.media_root:
+        parser.error("--media local needs --media-root (or MUSIC_ROOT)")
+
+    import_archive(args)
+
+    # Publish a new tracklist snapshot (see karaoke.tracklist) now, rather than leaving it to the next request.
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manage.py'),
+                    'publish_tracklist'], env=dict(os.environ, DATABASE_URL=args.database), check=True)
@@ -1,5 +1,17 @@
 from django.apps import AppConfig
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 
 
 class KaraokeConfig(AppConfig):
     name = 'karaoke'
+
+    def ready(self):
+        from . import tracklist
+        from .models import Song
+
+        def song_changed(sender, **kwargs):
+            transaction.on_commit(tracklist.schedule)
+
+        post_save.connect(song_changed, sender=Song, weak=False, dispatch_uid='tracklist-song-saved')
+        post_delete.connect(song_changed, sender=Song, weak=False, dispatch_uid='tracklist-song-deleted')
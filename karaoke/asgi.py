@@ -0,0 +1,205 @@
+"""Plain ASGI handlers for HTTP paths that don't need Django's request/response machinery or middleware."""
+import asyncio
+import functools
+import mimetypes
+import os
+import re
+import stat
+import time
+from urllib.parse import parse_qs, quote
+
+CHUNK_SIZE = 256 * 1024
+# Generated song files are named after a hash of their content; see ultrastar.compiled_name and audio.preview_name.
+CONTENT_ADDRESSED = re.compile(r'\.([0-9a-f]{16})\.\w+$')
+IMMUTABLE = b"public, max-age=31536000, immutable"
+REVALIDATE = b"public, max-age=3600"
+
+
+class NtpResponder:
+    """Answers /ntp with "<server time - browser time>:<browser time>" in milliseconds, as fast as possible.
+
+    Same response as karaoke.views.ntp, except that the offset has microsecond precision.
+    """
+    def __init__(self, scope):
+        self.scope = scope
+
+    async def __call__(self, receive, send):
+        now = time.time() * 1000
+        try:
+            browser_time = int(parse_qs(self.scope['query_string'].decode('latin-1'))['t'][0])
+        except (KeyError, ValueError):
+            await respond(send, 400, b"Bad Request")
+            return
+        await respond(send, 200, f"{now - browser_time:.3f}:{browser_time}".encode())
+
+
+async def respond(send, status, body, content_type=b"text/plain"):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode()),
+                    (b'cache-control', b'no-store')],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def parse_range(value, size):
+    """Returns (start, end) for a single "bytes=" range, None if the header should be ignored, or False if the range
+    can't be satisfied. end is exclusive.
+    """
+    units, _, spec = value.partition('=')
+    first, dash, last = spec.strip().partition('-')
+    # Anything else, including multiple ranges, gets the whole file.
+    if units.strip() != 'bytes' or not dash or not (first or last):
+        return None
+    if not (first or '0').isdigit() or not (last or '0').isdigit():
+        return None
+    if not first:
+        suffix = int(last)
+        return (max(size - suffix, 0), size) if suffix else False
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, min(int(last) + 1 if last else size, size)
+
+
+def _resolve(root, name):
+    """Returns the real path of name under root, or None if that isn't inside root."""
+    path = os.path.realpath(os.path.join(root, name))
+    return path if path.startswith(root + os.sep) else None
+
+
+def _open(root, name):
+    """Opens name under root, returning (file, stat) if it's a regular file inside root and None otherwise."""
+    path = _resolve(root, name)
+    if path is None:
+        return None
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    info = os.fstat(f.fileno())
+    if not stat.S_ISREG(info.st_mode):
+        f.close()
+        return None
+    return f, info
+
+
+def _etag(name, info):
+    match = CONTENT_ADDRESSED.search(name)
+    if match:
+        return f'"{match.group(1)}"'.encode()
+    # Anything else may be replaced in place by the importer, which always writes a new inode.
+    return f'"{info.st_ino:x}-{info.st_size:x}-{info.st_mtime_ns:x}"'.encode()
+
+
+class MediaFiles:
+    """Serves song files from root at prefix (MUSIC_ROOT at MUSIC_URL), without tying up Django.
+
+    Handles single byte ranges, for seeking in audio and video, and conditional requests against strong ETags: the
+    content hash in generated files' names, and the inode, size and mtime of anything else. Files are opened and read
+    off the event loop, or sent with the server's zero-copy extension if it has one. With accel_redirect set, nginx is
+    told to send the file instead (and does all that itself).
+    """
+    def __init__(self, root, prefix, accel_redirect=None):
+        self.root = os.path.realpath(root)
+        self.prefix = prefix
+        self.accel_redirect = accel_redirect
+
+    def __call__(self, scope):
+        return functools.partial(self.serve, scope)
+
+    async def serve(self, scope, receive, send):
+        if scope['method'] not in ('GET', 'HEAD'):
+            await respond(send, 405, b"Method Not Allowed")
+            return
+        name = scope['path'][len(self.prefix):]
+        loop = asyncio.get_event_loop()
+        headers = [
+            (b'content-type', (mimetypes.guess_type(name)[0] or 'application/octet-stream').encode()),
+            (b'cache-control', IMMUTABLE if CONTENT_ADDRESSED.search(name) else REVALIDATE),
+        ]
+        if self.accel_redirect:
+            if await loop.run_in_executor(None, _resolve, self.root, name) is None:
+                await respond(send, 404, b"Not Found")
+                return
+            headers.append((b'x-accel-redirect', quote(self.accel_redirect + name).encode()))
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b""})
+            return
+        opened = await loop.run_in_executor(None, _open, self.root, name)
+        if opened is None:
+            await respond(send, 404, b"Not Found")
+            return
+        f, info = opened
+        with f:
+            etag = _etag(name, info)
+            headers += [(b'etag', etag), (b'accept-ranges', b'bytes')]
+            request_headers = dict(scope['headers'])
+
+            if_none_match = request_headers.get(b'if-none-match')
+            if if_none_match and (if_none_match.strip() == b'*' or etag in
+                                  (x.strip().replace(b'W/', b'', 1) for x in if_none_match.split(b','))):
+                await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+                await send({'type': 'http.response.body', 'body': b""})
+                return
+
+            status, start, end = 200, 0, info.st_size
+            byte_range = request_headers.get(b'range')
+            # If-Range with anything but the current ETag means the client's partial copy is stale.
+            if byte_range and request_headers.get(b'if-range', etag) == etag:
+                byte_range = parse_range(byte_range.decode('latin-1'), info.st_size)
+                if byte_range is False:
+                    headers.append((b'content-range', f"bytes */{info.st_size}".encode()))
+                    await send({'type': 'http.response.start', 'status': 416, 'headers': headers})
+                    await send({'type': 'http.response.body', 'body': b""})
+                    return
+                if byte_range:
+                    status, (start, end) = 206, byte_range
+                    headers.append((b'content-range', f"bytes {start}-{end - 1}/{info.st_size}".encode()))
+            headers.append((b'content-length', str(end - start).encode()))
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            if scope['method'] == 'HEAD':
+                await send({'type': 'http.response.body', 'body': b""})
+                return
+            await self._send_file(scope, send, f, start, end - start)
+
+    async def _send_file(self, scope, send, f, offset, count):
+        if 'http.response.zerocopysend' in scope.get('extensions', {}):
+            await send({'type': 'http.response.zerocopysend', 'file': f, 'offset': offset, 'count': count})
+            return
+        loop = asyncio.get_event_loop()
+        while count > 0:
+            chunk = await loop.run_in_executor(None, os.pread, f.fileno(), min(CHUNK_SIZE, count), offset)
+            if not chunk:
+                # Truncated underneath us; nothing sensible left to do but stop.
+                break
+            offset += len(chunk)
+            count -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b""})
+
+
+class FastPathRouter:
+    """Sends a few hot paths to raw handlers and everything else on to application (usually Django).
+
+    prefixes maps path prefixes to further handlers, such as MediaFiles.
+    """
+    routes = {
+        '/ntp': NtpResponder,
+    }
+
+    def __init__(self, application, prefixes=None):
+        self.application = application
+        self.prefixes = prefixes or {}
+
+    def __call__(self, scope):
+        path = scope['path']
+        if path in self.routes:
+            return self.routes[path](scope)
+        for prefix, handler in self.prefixes.items():
+            if path.startswith(prefix):
+                return handler(scope)
+        return self.application(scope)
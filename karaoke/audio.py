@@ -0,0 +1,93 @@
+"""MP3 metadata and preview clips for imported songs.
+
+Like karaoke.ultrastar, this has no Django dependencies so importmlk.py can use it directly. Nothing here decodes
+audio: mutagen reads the frame headers and any Xing/VBRI/LAME header, and previews are cut on frame boundaries.
+"""
+import hashlib
+import re
+from collections import namedtuple
+
+import mutagen.mp3
+
+PREVIEW_SECONDS = 15
+DEFAULT_PREVIEW_START = 30
+
+AudioInfo = namedtuple("AudioInfo", "duration bitrate sample_rate replay_gain")
+
+# Layer III only; index 0 is "free format", which we don't handle.
+BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),  # MPEG 1
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),  # MPEG 2
+    0: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),  # MPEG 2.5
+}
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+_gain = re.compile(r'\s*([+-]?\d+(?:\.\d+)?)')
+
+
+def audio_info(path: str):
+    mp3 = mutagen.mp3.MP3(path)
+    info = mp3.info
+    replay_gain = info.track_gain
+    # An explicit ReplayGain tag beats whatever the encoder wrote in its LAME header.
+    tag = mp3.tags.get('TXXX:REPLAYGAIN_TRACK_GAIN') if mp3.tags else None
+    if tag and _gain.match(tag.text[0]):
+        replay_gain = float(_gain.match(tag.text[0]).group(1))
+    return AudioInfo(info.length, info.bitrate // 1000, info.sample_rate, replay_gain)
+
+
+def _frame(data: bytes, offset: int):
+    """Returns (length in bytes, duration in seconds) of the Layer III frame at offset, or None."""
+    if data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[offset + 1] >> 3) & 3
+    layer = (data[offset + 1] >> 1) & 3
+    bitrate_index = data[offset + 2] >> 4
+    rate_index = (data[offset + 2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = BITRATES[version][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (data[offset + 2] >> 1) & 1
+    samples = 1152 if version == 3 else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples / sample_rate
+
+
+def _audio_start(data: bytes):
+    if data[:3] != b'ID3' or len(data) < 10:
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+
+def preview_clip(data: bytes, start: float, seconds: float = PREVIEW_SECONDS):
+    """Cuts roughly [start, start + seconds) out of an MP3 without re-encoding it, or returns None if it can't.
+
+    The first frame or two may reach back into the bit reservoir of frames that were dropped; players cope with that
+    by skipping them.
+    """
+    offset = _audio_start(data)
+    elapsed = 0
+    clip_start = None
+    while offset + 4 <= len(data):
+        frame = _frame(data, offset)
+        if frame is None:
+            # Junk between frames; look for the next sync word.
+            offset = data.find(b'\xff', offset + 1)
+            if offset < 0:
+                offset = len(data)
+            continue
+        length, duration = frame
+        if clip_start is None and elapsed >= start:
+            clip_start = offset
+        elapsed += duration
+        offset += length
+        if clip_start is not None and elapsed >= start + seconds:
+            break
+    if clip_start is None:
+        return None
+    return data[clip_start:min(offset, len(data))]
+
+
+def preview_name(content: bytes):
+    return f"preview.{hashlib.sha256(content).hexdigest()[:16]}.mp3"
@@ -0,0 +1,75 @@
+"""A channel layer that spreads parties over several Redis servers.
+
+Each party lives on one shard, chosen by rendezvous hashing its id (see redis_conn.rendezvous): its group, its
+members' sockets' channels (PartyConsumer creates them with new_channel(shard_key=party_id)) and its PartyState keys.
+Group sends and relays within a party therefore never leave its shard.
+"""
+import hashlib
+import re
+
+from channels_redis.core import RedisChannelLayer
+
+from .redis_conn import rendezvous
+
+# "party-<id>", as used by PartyState.group_name.
+PARTY_GROUP = re.compile(r'^party-(.+)$')
+# Marks which shard a process-specific channel was created on, e.g. "specific.shard-1a2b3c4d.AbCdEfGh!xyz".
+CHANNEL_SHARD = re.compile(r'\.shard-([0-9a-f]{8})\.')
+
+
+def shard_id(url):
+    return hashlib.md5(url.encode()).hexdigest()[:8]
+
+
+class ShardedRedisChannelLayer:
+    """Routes each channel and group to one of several RedisChannelLayers, each talking to a single Redis.
+
+    Named channels (e.g. party.persist) and groups other than parties' are hashed by name. Process-specific channels
+    stay on the shard they were created on, and a group may only hold channels from its own shard.
+    """
+    extensions = ["groups", "flush"]
+
+    def __init__(self, shards, **options):
+        self.urls = list(shards)
+        self.layers = {url: RedisChannelLayer(hosts=[url], **options) for url in self.urls}
+        self.by_id = {shard_id(url): url for url in self.urls}
+
+    def _url(self, name):
+        if '!' in name:
+            match = CHANNEL_SHARD.search(name[:name.index('!')])
+            if match:
+                return self.by_id[match.group(1)]
+        match = PARTY_GROUP.match(name)
+        return rendezvous(match.group(1) if match else name, self.urls)
+
+    def _layer(self, name):
+        return self.layers[self._url(name)]
+
+    async def new_channel(self, prefix="specific", shard_key=None):
+        url = rendezvous(shard_key, self.urls) if shard_key is not None else self.urls[0]
+        return await self.layers[url].new_channel(f"{prefix}.shard-{shard_id(url)}")
+
+    async def send(self, channel, message):
+        await self._layer(channel).send(channel, message)
+
+    async def receive(self, channel):
+        return await self._layer(channel).receive(channel)
+
+    async def group_add(self, group, channel):
+        if self._url(group) != self._url(channel):
+            raise ValueError(f"Channel {channel} is not on the same shard as group {group}")
+        await self._layer(group).group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await self._layer(group).group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        await self._layer(group).group_send(group, message)
+
+    async def flush(self):
+        for layer in self.layers.values():
+            await layer.flush()
+
+    async def close_pools(self):
+        for layer in self.layers.values():
+            await layer.close_pools()
@@ -1,135 +1,423 @@
+import asyncio
+import functools
 import json
+import logging
 
-from channels import Channel, Group
-from channels.security.websockets import allowed_hosts_only
-from channels.sessions import channel_and_http_session
+from asgiref.sync import sync_to_async
+from channels.consumer import SyncConsumer
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull, StopConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.utils import await_many_dispatch
+from django.conf import settings
+from django.db import connection
 
-from .models import Party, PartyMember, Playlist, Song
+from . import metrics, tracklist
+from .channel_layer import ShardedRedisChannelLayer
+from .models import Party, PartyMember, Playlist
+from .party_state import PartyState
 
+logger = logging.getLogger(__name__)
 
-@allowed_hosts_only
-@channel_and_http_session
-def party_connected(message, party_id):
-    if party_id != message.http_session['party_id']:
-        raise Exception(f"Party ID mismatch: {party_id} != {message.channel_session['party_id']}")
-    old_member_id = message.http_session.get('member_id')
-    if old_member_id:
+RELAY_PREFIX = '{"action":"relay","target":"'
+
+
+def _reject_constant(name):
+    # Python's parser accepts NaN and (-)Infinity, but they aren't JSON and the browser's JSON.parse rejects them.
+    raise ValueError(f"{name} is not valid JSON")
+
+
+_decoder = json.JSONDecoder(parse_constant=_reject_constant)
+
+
+def splice_relay(text):
+    """Picks apart a relay frame in exactly the shape the client sends it.
+
+    Returns (target, key, payload), where payload is the raw JSON text of the message(s) to forward, or None if the
+    frame needs to go through the normal parser.
+    """
+    if not text.startswith(RELAY_PREFIX):
+        return None
+    end = text.find('"', len(RELAY_PREFIX))
+    if end < 0:
+        return None
+    target = text[len(RELAY_PREFIX):end]
+    if '\\' in target:
+        return None
+    for key in ('message', 'messages'):
+        separator = f',"{key}":'
+        if text.startswith(separator, end + 1):
+            start = end + 1 + len(separator)
+            try:
+                # Validates the payload without building a new string for it.
+                _, stop = _decoder.raw_decode(text, start)
+            except ValueError:
+                return None
+            if text[stop:] != '}' or (key == 'messages' and text[start] != '['):
+                return None
+            return target, key, text[start:stop]
+    return None
+
+
+class PartyConsumer(AsyncJsonWebsocketConsumer):
+    """One party member's websocket.
+
+    The member, party and nick live on the consumer for the lifetime of the socket; the HTTP session is only read,
+    once, during the handshake.
+    """
+    async def __call__(self, receive, send):
+        # As AsyncConsumer.__call__, except that with a sharded layer our channel goes on the party's shard, so that
+        # relays and group sends within the party stay on one Redis.
+        self.channel_layer = get_channel_layer(self.channel_layer_alias)
+        if isinstance(self.channel_layer, ShardedRedisChannelLayer):
+            self.channel_name = await self.channel_layer.new_channel(
+                shard_key=self.scope['url_route']['kwargs']['party_id'])
+        else:
+            self.channel_name = await self.channel_layer.new_channel()
+        self.channel_receive = functools.partial(self.channel_layer.receive, self.channel_name)
+        self.base_send = send
         try:
-            member = PartyMember.objects.get(id=old_member_id)
-        except:
+            await await_many_dispatch([receive, self.channel_receive], self.dispatch)
+        except StopConsumer:
             pass
-        else:
-            if member.nick:
-                group = Group(f"party-{member.party.id}")
-                group.send({"text": json.dumps({
-                    "action": "member_left",
-                    "channel": member.channel,
-                    "nick": member.nick
-                })})
-                group.discard(message.reply_channel)
-            member.delete()
-        message.http_session.delete('member_id')
-    party = Party.objects.get(id=party_id)
-    if party.members.count() >= 6:
-        print("Too many members!")
-        message.reply_channel.send({"text": json.dumps({"action": "goodbye", "message": "room_full"})})
-        message.reply_channel.send({"close": True})
-        return
-    member = PartyMember(party=party, channel=message.reply_channel.name)
-    member.save()
-    message.http_session['member_id'] = member.id
-    message.http_session.save()
-    message.reply_channel.send({"accept": True})
-    message.reply_channel.send({"text": json.dumps({"action": "hello", "channel": message.reply_channel.name})})
-
-
-def get_playlist(party):
-    print([x.song.id for x in Playlist.objects.filter(party=party).order_by('id')])
-    return [x.song.id for x in Playlist.objects.filter(party=party).order_by('id')]
-
-
-@channel_and_http_session
-def party_message(message):
-    content = json.loads(message.content['text'])
-    action = content['action']
-
-    if action == 'hello':
-        party = Party.objects.get(id=message.http_session['party_id'])
-        member = PartyMember.objects.get(id=message.http_session['member_id'])
-        member.nick = content['nick']
-
-        group = Group(f"party-{party.id}")
-
-        all_colours = ['#058fbe', '#d70000', '#00b100', '#a300c4', '#ee7600', '#122b53']
-        used_colours = set(x.colour for x in party.members.all())
-        for colour in all_colours:
-            if colour not in used_colours:
-                member.colour = colour
-                break
+
+    async def connect(self):
+        self.party_id = self.scope['url_route']['kwargs']['party_id']
+        self.state = PartyState(self.party_id)
+        self.group_name = self.state.group_name
+        self.member_id = None
+        self.nick = None
+        # The channel of the socket this one took over from, if it resumed an existing member.
+        self.resumed_from = None
+        # Channels of this party's members, as last seen; relays may only go to these.
+        self.peers = set()
+        self.action = 'connect'
+        with metrics.timer('handler_seconds', 'connect'):
+            await self._connect()
+
+    async def _connect(self):
+        try:
+            old_member, self.member_id = await database_sync_to_async(self._join)()
+        except (KeyError, Party.DoesNotExist):
+            await self.close()
+            return
+
+        if self.resumed_from:
+            # The old socket may not have noticed it's dead yet, or may be another tab that's still open; it no longer
+            # speaks for this member either way.
+            await self.channel_layer.group_discard(self.group_name, self.resumed_from)
+            await self.layer_send(self.resumed_from, {"type": "party.evict", "reason": "replaced"})
+            await self.persist("member.resumed", member=self.member_id, channel=self.channel_name)
+        elif old_member:
+            await self.group_send({
+                "action": "member_left",
+                "channel": old_member['channel'],
+                "nick": old_member['nick']
+            })
+
+        await self.accept()
+        if self.member_id is None:
+            metrics.observe('rejected', 'room_full', 1)
+            await self.send_json({"action": "goodbye", "message": "room_full"})
+            await self.close()
+            return
+        await self.send_json({"action": "hello", "channel": self.channel_name})
+
+    def _join(self):
+        with metrics.queries('connect'):
+            return self._join_party()
+
+    def _join_party(self):
+        session = self.scope['session']
+        if self.party_id != session['party_id']:
+            raise KeyError(f"Party ID mismatch: {self.party_id} != {session['party_id']}")
+        party = Party.objects.get(id=self.party_id)
+        self.state.ensure_loaded()
+        old_member = None
+        old_member_id = self.state.session_member(session.session_key)
+        if old_member_id:
+            # This browser's previous socket, which has either just dropped or hasn't noticed it's dead yet.
+            # The session cookie is the resume token: if the member is still within its grace period, carry on as it.
+            old_member = self.state.resume(old_member_id, self.channel_name)
+            if old_member:
+                self.resumed_from = old_member['channel']
+                return old_member, old_member_id
+            old_member = self.state.leave(old_member_id)
+            PartyMember.objects.filter(id=old_member_id).delete()
+        member = PartyMember(party=party, channel=self.channel_name)
         member.save()
+        # Admission is decided in Redis, so simultaneous joins can't all squeeze into the last slot.
+        if self.state.admit(member.id, party.max_members, session.session_key):
+            return old_member, member.id
+        member.delete()
+        return old_member, None
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not text_data or self.member_id is None:
+            return
+        relay = splice_relay(text_data)
+        if relay:
+            handler, content = PartyConsumer.splice, relay
+            self.action = 'relay'
+        else:
+            content = _decoder.decode(text_data)
+            handler = self.handlers.get(content['action'])
+            if handler is None:
+                return
+            self.action = content['action']
+        metrics.observe('received_bytes', self.action, len(text_data))
+        with metrics.timer('handler_seconds', self.action):
+            await handler(self, content)
+
+    async def hello(self, content):
+        self.nick = content['nick']
+        member, members = await sync_to_async(self.state.join)(self.member_id, self.channel_name, self.nick)
+        await self.persist("member.joined", member=self.member_id, nick=member['nick'], colour=member['colour'])
 
-        message.http_session['nickname'] = content['nick']
-        message.reply_channel.send({"text": json.dumps({
+        await self.send_json({
             "action": "member_list",
-            "members": {x.channel: {'nick': x.nick, 'colour': x.colour, 'id': x.id} for x in party.members.all()},
-        })})
-        message.reply_channel.send({"text": json.dumps({
-            "action": "playlist",
-            "playlist": get_playlist(party)
-        })})
-        group.add(message.reply_channel)
-        group.send({"text": json.dumps({
+            "members": {x['channel']: {'nick': x['nick'], 'colour': x['colour'], 'id': x['id']} for x in members},
+        })
+        await self.get_playlist(content)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        if self.resumed_from:
+            # Peers keep their WebRTC connections and just remap the channel.
+            await self.group_send({
+                "action": "member_resumed",
+                "old_channel": self.resumed_from,
+                "channel": self.channel_name,
+                "nick": member['nick'],
+                "colour": member['colour'],
+                "id": member['id'],
+            })
+            return
+        await self.group_send({
             "action": "new_member",
-            "channel": message.reply_channel.name,
-            "nick": member.nick,
-            "colour": member.colour,
-            "id": member.id,
-        })})
-        message.http_session.save()
-    elif action == 'relay':
-        Channel(content['target']).send({"text": json.dumps({
+            "channel": self.channel_name,
+            "nick": member['nick'],
+            "colour": member['colour'],
+            "id": member['id'],
+        })
+
+    async def is_peer(self, channel):
+        if channel not in self.peers:
+            self.peers = await sync_to_async(self.state.member_channels)()
+        return channel in self.peers
+
+    async def splice(self, relay):
+        target, key, payload = relay
+        if not await self.is_peer(target):
+            return
+        await self.layer_send(target, {
+            "type": "party.frame",
+            "text": f'{{"action":"relay","origin":{json.dumps(self.channel_name)},"{key}":{payload}}}',
+        })
+
+    async def relay(self, content):
+        if not await self.is_peer(content['target']):
+            return
+        key = 'messages' if 'messages' in content else 'message'
+        await self.layer_send(content['target'], {"type": "party.frame", "text": json.dumps({
             "action": "relay",
-            "origin": message.reply_channel.name,
-            "message": content['message'],
+            "origin": self.channel_name,
+            key: content[key],
         })})
-    elif action == 'addToQueue':
-        party = Party.objects.get(id=message.http_session['party_id'])
-        song = Song.objects.get(id=content['song'])
-        if Playlist.objects.filter(party=party, song=song).exists():
+
+    async def add_to_queue(self, content):
+        song = int(content['song'])
+        if song not in (await sync_to_async(tracklist.current)()).song_ids:
+            return
+        position, version = await sync_to_async(self.state.add_to_queue)(song)
+        if position is None:
             # Silently do nothing if this would be a duplicate.
             return
-        entry = Playlist(party=party, song=song, order=1)
-        entry.save()
-        Group(f"party-{party.id}").send({"text": json.dumps({
-            "action": "playlist",
-            "playlist": get_playlist(party)
-        })})
-    elif action == 'removeFromQueue':
-        party = Party.objects.get(id=message.http_session['party_id'])
-        song = Song.objects.get(id=content['song'])
-        Playlist.objects.filter(party=party, song=song).delete()
-        Group(f"party-{party.id}").send({"text": json.dumps({
+        await self.persist("queue.add", party=self.party_id, song=song, position=position)
+        await self.playlist_changed()
+
+    async def remove_from_queue(self, content):
+        song = int(content['song'])
+        version = await sync_to_async(self.state.remove_from_queue)(song)
+        if version is None:
+            return
+        await self.persist("queue.remove", party=self.party_id, song=song)
+        await self.playlist_changed()
+
+    async def move_in_queue(self, content):
+        song = int(content['song'])
+        direction = content['direction']
+        if direction not in ('front', 'up', 'down'):
+            return
+        position, version, renumbered = await sync_to_async(self.state.move_in_queue)(song, direction)
+        if version is None:
+            return
+        if renumbered:
+            positions = [[x, position if x == song else p] for x, p in renumbered]
+            await self.persist("queue.renumber", party=self.party_id, positions=positions)
+        else:
+            await self.persist("queue.move", party=self.party_id, song=song, position=position)
+        await self.playlist_changed()
+
+    async def pop_queue(self, content):
+        song, version = await sync_to_async(self.state.pop_queue)()
+        # Only whoever asked needs the answer; everyone else hears about it with the next playlist broadcast.
+        await self.send_json({"action": "next_song", "song": song})
+        if song is None:
+            return
+        await self.persist("queue.remove", party=self.party_id, song=song)
+        await self.playlist_changed()
+
+    async def get_playlist(self, content):
+        version, playlist = await sync_to_async(self.state.playlist)()
+        await self.send_json({
             "action": "playlist",
-            "playlist": get_playlist(party)
-        })})
+            "playlist": playlist,
+            "version": version,
+        })
+
+    async def heartbeat(self, content):
+        await sync_to_async(self.state.heartbeat)(self.member_id)
+
+    handlers = {
+        'hello': hello,
+        'heartbeat': heartbeat,
+        'relay': relay,
+        'addToQueue': add_to_queue,
+        'removeFromQueue': remove_from_queue,
+        'moveInQueue': move_in_queue,
+        'popQueue': pop_queue,
+        'getPlaylist': get_playlist,
+    }
+
+    async def disconnect(self, code):
+        if self.member_id is None:
+            return
+        self.action = 'disconnect'
+        with metrics.timer('handler_seconds', 'disconnect'):
+            await self._disconnect()
+
+    async def _disconnect(self):
+        if self.nick is None and self.resumed_from is None:
+            await sync_to_async(self.state.leave)(self.member_id, self.channel_name)
+            await self.persist("member.left", member=self.member_id)
+            return
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        # Hold on to the member for a while in case this browser reconnects. If this process goes away first,
+        # the member stops heartbeating and sweep_parties evicts it instead.
+        asyncio.ensure_future(self.expire_member(self.member_id, self.channel_name, settings.PARTY_RESUME_GRACE))
+
+    async def expire_member(self, member_id, channel, delay):
+        await asyncio.sleep(delay)
+        member = await sync_to_async(self.state.leave)(member_id, channel)
+        if member is None:
+            # Resumed on another socket, or already swept.
+            return
+        await self.persist("member.left", member=member_id)
+        await self.group_send({
+            "action": "member_left",
+            "channel": channel,
+            "nick": member['nick']
+        }, action='expire')
+
+    async def playlist_changed(self):
+        # Whoever takes the lock broadcasts once the window closes, covering every change made in the meantime.
+        window = settings.PLAYLIST_BROADCAST_WINDOW
+        if await sync_to_async(self.state.claim_broadcast)(window * 10 + 1):
+            asyncio.ensure_future(self.broadcast_playlist(window))
+
+    async def broadcast_playlist(self, delay):
+        await asyncio.sleep(delay)
+        previous, version, ops, playlist = await sync_to_async(self.state.take_broadcast)()
+        if version == previous:
+            return
+        if settings.PLAYLIST_DELTAS and ops is not None:
+            await self.group_send({
+                "action": "playlist_delta",
+                "from": previous,
+                "version": version,
+                "ops": ops,
+            }, action='broadcast')
+        else:
+            await self.group_send({
+                "action": "playlist",
+                "playlist": playlist,
+                "version": version,
+            }, action='broadcast')
+
+    async def group_send(self, message, action=None):
+        # Encode once here rather than once per recipient.
+        with metrics.timer('layer_send_seconds', action or self.action):
+            await self.channel_layer.group_send(self.group_name, {"type": "party.frame", "text": json.dumps(message)})
+
+    async def layer_send(self, channel, message):
+        with metrics.timer('layer_send_seconds', self.action):
+            await self.channel_layer.send(channel, message)
+
+    async def party_evict(self, event):
+        # The sweeper has already removed us and told everyone else, or another socket has taken over as our member.
+        self.member_id = None
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if 'reason' in event:
+            # Otherwise the client reconnects, resumes the same member, and evicts the socket that replaced us.
+            await self.send_json({"action": "goodbye", "message": event['reason']})
+        await self.close()
+
+    async def party_frame(self, event):
+        self.action = 'frame'
+        await self.send(text_data=event['text'])
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None:
+            metrics.observe('sent_bytes', self.action, len(text_data))
+        await super().send(text_data, bytes_data, close)
+
+    async def send_json(self, content, close=False):
+        # AsyncJsonWebsocketConsumer.send_json bypasses our send(), so route it through explicitly.
+        await self.send(text_data=await self.encode_json(content), close=close)
+
+    async def persist(self, type, **change):
+        try:
+            await self.layer_send("party.persist", dict(change, type=type))
+        except ChannelFull:
+            # Redis still has the change, so the party carries on; only the copy in Postgres misses it.
+            logger.error("party.persist is full; dropped %s for party %s", type, self.party_id)
+            metrics.observe('persist_dropped', type, 1)
+
+
+class PartyPersistConsumer(SyncConsumer):
+    """Writes party changes made in Redis back to Postgres, off the realtime path."""
+    def member_joined(self, message):
+        PartyMember.objects.filter(id=message['member']).update(nick=message['nick'], colour=message['colour'])
+
+    def member_resumed(self, message):
+        PartyMember.objects.filter(id=message['member']).update(channel=message['channel'])
+
+    def member_left(self, message):
+        PartyMember.objects.filter(id=message['member']).delete()
+
+    def queue_add(self, message):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO karaoke_playlist (party_id, song_id, position) VALUES (%s, %s, %s) "
+                           "ON CONFLICT (party_id, song_id) DO NOTHING",
+                           [message['party'], message['song'], message['position']])
+
+    def queue_move(self, message):
+        Playlist.objects.filter(party_id=message['party'], song_id=message['song']).update(
+            position=message['position'])
+
+    def queue_renumber(self, message):
+        positions = message['positions']
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE karaoke_playlist p SET position = v.position "
+                           f"FROM (VALUES {', '.join(['(%s, %s::float)'] * len(positions))}) v (song_id, position) "
+                           "WHERE p.party_id = %s AND p.song_id = v.song_id",
+                           [x for pair in positions for x in pair] + [message['party']])
+
+    def queue_remove(self, message):
+        Playlist.objects.filter(party_id=message['party'], song_id=message['song']).delete()
 
 
-@channel_and_http_session
-def party_disconnected(message):
-    if 'member_id' not in message.http_session:
-        return
-    try:
-        PartyMember.objects.get(id=message.http_session['member_id']).delete()
-    except PartyMember.DoesNotExist:
-        print("No such party member.")
-    message.http_session.delete('member_id')
-    message.http_session.save()
-    if 'nickname' not in message.http_session:
-        return
-    group = Group(f"party-{message.http_session['party_id']}")
-    group.discard(message.reply_channel)
-    group.send({"text": json.dumps({
-        "action": "member_left",
-        "channel": message.reply_channel.name,
-        "nick": message.http_session['nickname']
-    })})
+class TracklistPublishConsumer(SyncConsumer):
+    """Rebuilds the tracklist snapshot after songs change, so that no request has to."""
+    def tracklist_publish(self, message):
+        tracklist.publish_scheduled()
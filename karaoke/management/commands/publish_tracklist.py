@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from karaoke import tracklist
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the tracklist snapshot served by /tracklist."
+
+    def handle(self, *args, **options):
+        snapshot = tracklist.publish()
+        self.stdout.write(f"Published tracklist {snapshot.version} "
+                          f"({', '.join(f'{k}: {len(v)} bytes' for k, v in snapshot.blobs.items())})")
@@ -0,0 +1,85 @@
+import json
+import time
+from datetime import datetime, timezone
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from karaoke.models import Party, PartyMember, Playlist
+from karaoke.party_state import ACTIVE_KEY, PartyState
+from karaoke.redis_conn import get_redis_shards
+
+
+class Command(BaseCommand):
+    help = "Evicts party members that stopped sending heartbeats, and deletes parties nobody has used in a while."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale', type=int, default=60,
+                            help="Seconds without a heartbeat before a member is evicted; "
+                                 "keep this above PARTY_RESUME_GRACE")
+        parser.add_argument('--idle', type=int, default=24 * 3600,
+                            help="Seconds without any activity before a party is deleted")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        now = time.time()
+        evicted = self.evict_stale_members(now - options['stale'], now - options['idle'])
+        deleted = self.delete_idle_parties(now - options['idle'], options['batch_size'])
+        self.stdout.write(f"Evicted {evicted} stale members; deleted {deleted} idle parties.")
+
+    def evict_stale_members(self, stale, idle):
+        layer = get_channel_layer()
+        evicted = 0
+        # Each shard keeps its own index of the parties that live on it.
+        active = [x for redis in get_redis_shards() for x in redis.zrangebyscore(ACTIVE_KEY, idle, '+inf')]
+        for party_id in active:
+            state = PartyState(party_id.decode())
+            stale_ids = state.stale_members(stale)
+            if not stale_ids:
+                continue
+            for member_id in stale_ids:
+                member = state.leave(member_id)
+                if member is None:
+                    continue
+                async_to_sync(layer.group_send)(state.group_name, {"type": "party.frame", "text": json.dumps({
+                    "action": "member_left",
+                    "channel": member['channel'],
+                    "nick": member['nick'],
+                })})
+                # In case the socket is somehow still open.
+                async_to_sync(layer.send)(member['channel'], {"type": "party.evict"})
+            PartyMember.objects.filter(id__in=stale_ids).delete()
+            evicted += len(stale_ids)
+        return evicted
+
+    def delete_idle_parties(self, idle, batch_size):
+        shards = get_redis_shards()
+        active = {x.decode() for redis in shards for x in redis.zrangebyscore(ACTIVE_KEY, idle, '+inf')}
+        deleted = 0
+
+        # Live state can go straight away; rows are deleted in batches below once the party is old enough.
+        for redis in shards:
+            for party_id in redis.zrangebyscore(ACTIVE_KEY, '-inf', idle):
+                PartyState(party_id.decode()).clear()
+
+        cutoff = datetime.fromtimestamp(idle, timezone.utc)
+        last = ''
+        while True:
+            # Active parties are skipped here rather than in the query, which would otherwise carry every one of them.
+            candidates = list(Party.objects.filter(created__lt=cutoff, id__gt=last)
+                              .order_by('id').values_list('id', flat=True)[:batch_size])
+            if not candidates:
+                return deleted
+            last = candidates[-1]
+            batch = [x for x in candidates if x not in active]
+            if not batch:
+                continue
+            with transaction.atomic():
+                Playlist.objects.filter(party_id__in=batch).delete()
+                PartyMember.objects.filter(party_id__in=batch).delete()
+                Party.objects.filter(id__in=batch).delete()
+            for party_id in batch:
+                PartyState(party_id).clear()
+            deleted += len(batch)
@@ -0,0 +1,189 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+from django.db import connection
+
+from .redis_conn import get_redis
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+
+# Every process (web worker or not) adds what it has observed to these Redis hashes, one per metric and action, at most
+# FLUSH_INTERVAL seconds after observing it, so /metrics shows the whole deployment whichever worker answers.
+KEYS_KEY = "metrics:keys"
+HISTOGRAM_KEY = "metrics:{metric}:{action}"
+FLUSH_INTERVAL = 1
+
+METRICS = OrderedDict([
+    ('handler_seconds', ("Time spent handling a websocket event.", TIME_BUCKETS)),
+    ('db_queries', ("Database queries made while handling a websocket event.", COUNT_BUCKETS)),
+    ('db_seconds', ("Time spent in database queries while handling a websocket event.", TIME_BUCKETS)),
+    ('layer_send_seconds', ("Time spent sending to the channel layer.", TIME_BUCKETS)),
+    ('received_bytes', ("Size of frames received from clients.", SIZE_BUCKETS)),
+    ('sent_bytes', ("Size of frames sent to clients.", SIZE_BUCKETS)),
+    ('rejected', ("Websockets turned away, by reason; the count is what matters.", COUNT_BUCKETS)),
+    ('persist_dropped', ("Party changes the party.persist channel had no room for, by type; the count is what matters.",
+                         COUNT_BUCKETS)),
+])
+
+enabled = settings.PARTY_METRICS
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Observations this process hasn't added to Redis yet.
+_pending = {}
+_lock = threading.Lock()
+_flusher = None
+
+
+def observe(metric, action, value):
+    global _flusher
+    if not enabled:
+        return
+    key = (metric, action)
+    with _lock:
+        if key not in _pending:
+            _pending[key] = Histogram(METRICS[metric][1])
+        _pending[key].observe(value)
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_forever, name="metrics-flush", daemon=True)
+            _flusher.start()
+
+
+def _flush_forever():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+def flush():
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            for (metric, action), histogram in pending.items():
+                key = HISTOGRAM_KEY.format(metric=metric, action=action)
+                pipe.sadd(KEYS_KEY, key)
+                for i, count in enumerate(histogram.counts):
+                    if count:
+                        pipe.hincrby(key, i, count)
+                pipe.hincrbyfloat(key, 'sum', histogram.sum)
+                pipe.hincrby(key, 'count', histogram.count)
+            pipe.execute()
+    except redis.RedisError:
+        # Try again next time rather than lose them.
+        with _lock:
+            for key, histogram in pending.items():
+                merged = _pending.setdefault(key, Histogram(histogram.buckets))
+                merged.counts = [x + y for x, y in zip(merged.counts, histogram.counts)]
+                merged.sum += histogram.sum
+                merged.count += histogram.count
+
+
+def collect():
+    """Returns every process's histograms, summed, by (metric, action)."""
+    flush()
+    r = get_redis()
+    keys = sorted(x.decode() for x in r.smembers(KEYS_KEY))
+    with r.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.hgetall(key)
+        stored = pipe.execute()
+    histograms = {}
+    for key, fields in zip(keys, stored):
+        _, metric, action = key.split(':', 2)
+        if metric not in METRICS or not fields:
+            continue
+        histogram = histograms[metric, action] = Histogram(METRICS[metric][1])
+        histogram.counts = [int(fields.get(str(i).encode(), 0)) for i in range(len(histogram.counts))]
+        histogram.sum = float(fields[b'sum'])
+        histogram.count = int(fields[b'count'])
+    return histograms
+
+
+class _Timer:
+    __slots__ = ('metric', 'action', 'start')
+
+    def __init__(self, metric, action):
+        self.metric = metric
+        self.action = action
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        observe(self.metric, self.action, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def timer(metric, action):
+    return _Timer(metric, action) if enabled else _null_timer
+
+
+@contextmanager
+def queries(action):
+    """Counts and times the queries made on this thread's database connection."""
+    if not enabled:
+        yield
+        return
+    was_debug = connection.force_debug_cursor
+    connection.force_debug_cursor = True
+    # The log is a bounded deque that only HTTP requests reset, so counting from its length stops working once it fills.
+    connection.queries_log.clear()
+    try:
+        yield
+    finally:
+        connection.force_debug_cursor = was_debug
+        made = list(connection.queries_log)
+        observe('db_queries', action, len(made))
+        observe('db_seconds', action, sum(float(x['time']) for x in made))
+
+
+def render():
+    histograms = collect()
+    lines = []
+    for metric, (description, buckets) in METRICS.items():
+        name = f"ponytone_{metric}"
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for (key, action), histogram in sorted(histograms.items()):
+            if key != metric:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{action="{action}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{action="{action}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{action="{action}"}} {histogram.count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karaoke', '0004_auto_20170907_0245'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(
+            'CREATE INDEX karaoke_song_title_trgm ON karaoke_song USING gin (lower(title) gin_trgm_ops)',
+            'DROP INDEX karaoke_song_title_trgm',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX karaoke_song_artist_trgm ON karaoke_song USING gin (lower(artist) gin_trgm_ops)',
+            'DROP INDEX karaoke_song_artist_trgm',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX karaoke_song_sort ON karaoke_song (lower(artist), lower(title), id)',
+            'DROP INDEX karaoke_song_sort',
+        ),
+        migrations.AlterField(
+            model_name='song',
+            name='genre',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
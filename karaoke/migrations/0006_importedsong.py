@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karaoke', '0005_song_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportedSong',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500, unique=True)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('assets', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('imported', models.DateTimeField(auto_now=True)),
+                ('song', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='imported', to='karaoke.Song')),
+            ],
+        ),
+    ]
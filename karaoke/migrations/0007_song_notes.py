@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karaoke', '0006_importedsong'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='notes',
+            field=models.CharField(max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karaoke', '0007_song_notes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='audio_length',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='bitrate',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='preview',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='replay_gain',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='sample_rate',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karaoke', '0008_song_audio'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='party',
+            name='max_members',
+            field=models.PositiveSmallIntegerField(default=6),
+        ),
+    ]
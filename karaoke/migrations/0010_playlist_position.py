@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karaoke', '0009_party_max_members'),
+    ]
+
+    operations = [
+        # Keep the first of any duplicates, which the old check-then-insert let through.
+        migrations.RunSQL(
+            'DELETE FROM karaoke_playlist a USING karaoke_playlist b '
+            'WHERE a.party_id = b.party_id AND a.song_id = b.song_id AND a.id > b.id',
+            migrations.RunSQL.noop,
+        ),
+        migrations.RenameField(
+            model_name='playlist',
+            old_name='order',
+            new_name='position',
+        ),
+        migrations.AlterField(
+            model_name='playlist',
+            name='position',
+            field=models.FloatField(),
+        ),
+        migrations.AlterUniqueTogether(
+            name='playlist',
+            unique_together=set([('party', 'song')]),
+        ),
+        migrations.AddIndex(
+            model_name='playlist',
+            index=models.Index(fields=['party', 'position'], name='karaoke_playlist_party_pos'),
+        ),
+        # Older rows were all written with order=1, so number each party's queue in insertion order.
+        # This has to come last: Postgres won't ALTER a table with deferred FK checks pending from an UPDATE.
+        migrations.RunSQL(
+            'UPDATE karaoke_playlist p SET position = r.n FROM ('
+            '  SELECT id, row_number() OVER (PARTITION BY party_id ORDER BY position, id) AS n FROM karaoke_playlist'
+            ') r WHERE p.id = r.id',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, JSONField
 from django.db import models
 
 
@@ -6,6 +6,7 @@ class Party(models.Model):
     id = models.CharField(max_length=10, unique=True, primary_key=True)
     created = models.DateTimeField(auto_now_add=True)
     songs = models.ManyToManyField('Song', through='Playlist')
+    max_members = models.PositiveSmallIntegerField(default=6)
 
 
 class PartyMember(models.Model):
@@ -24,16 +25,36 @@ class Song(models.Model):
     song_year = models.IntegerField(db_index=True, null=True)
     transcriber = models.CharField(max_length=255, null=True)
     is_mlk = models.BooleanField(default=False)
-    genre = models.CharField(max_length=255)
+    genre = models.CharField(max_length=255, db_index=True)
     updated = models.DateField(db_index=True, null=True)
     language = models.CharField(max_length=255, db_index=True)
     length = models.IntegerField(db_index=True)
     preview_start = models.IntegerField(null=True)
     parts = ArrayField(models.CharField(max_length=100), null=True)
     cover_image = models.CharField(max_length=100)
+    notes = models.CharField(max_length=40, null=True)
+    bitrate = models.IntegerField(null=True)
+    sample_rate = models.IntegerField(null=True)
+    audio_length = models.FloatField(null=True)
+    replay_gain = models.FloatField(null=True)
+    preview = models.CharField(max_length=40, null=True)
+
+
+class ImportedSong(models.Model):
+    """What importmlk.py last uploaded for a song directory, so re-runs only touch what changed."""
+    path = models.CharField(max_length=500, unique=True)
+    song = models.OneToOneField(Song, on_delete=models.CASCADE, related_name='imported')
+    fingerprint = models.CharField(max_length=64)
+    assets = JSONField(default=dict)
+    imported = models.DateTimeField(auto_now=True)
 
 
 class Playlist(models.Model):
     party = models.ForeignKey(Party, on_delete=models.CASCADE)
     song = models.ForeignKey(Song, on_delete=models.CASCADE)
-    order = models.PositiveIntegerField()
+    # Fractional, so that moving a song only ever rewrites its own row; see party_state.MOVE_IN_QUEUE.
+    position = models.FloatField()
+
+    class Meta:
+        unique_together = ('party', 'song')
+        indexes = [models.Index(fields=['party', 'position'], name='karaoke_playlist_party_pos')]
@@ -0,0 +1,389 @@
+import json
+import time
+
+from .models import PartyMember, Playlist
+from .redis_conn import get_redis
+
+COLOURS = ['#058fbe', '#d70000', '#00b100', '#a300c4', '#ee7600', '#122b53']
+
+# Parties by when a member last joined or sent a heartbeat; see management/commands/sweep_parties.py.
+ACTIVE_KEY = "parties:active"
+# How long a party's state counts as loaded from Postgres after anyone last joined it; see PartyState.ensure_loaded.
+LOADED_TTL = 7 * 86400
+# How long one caller may spend loading it before another is allowed to try.
+LOAD_TIMEOUT = 30
+LOAD_POLL_INTERVAL = 0.05
+
+# KEYS: members, colours. ARGV: member id, channel, nick, colours...
+# Gives the member the first free colour (keeping any it already holds) and returns the full member list. Once every
+# colour is taken, as in parties with more members than COLOURS, members share them round-robin.
+JOIN = """
+local colour = false
+for i = 4, #ARGV do
+    local holder = redis.call('HGET', KEYS[2], ARGV[i])
+    if holder == ARGV[1] then
+        colour = ARGV[i]
+        break
+    end
+end
+if not colour then
+    for i = 4, #ARGV do
+        if redis.call('HSETNX', KEYS[2], ARGV[i], ARGV[1]) == 1 then
+            colour = ARGV[i]
+            break
+        end
+    end
+end
+if not colour then
+    colour = ARGV[4 + redis.call('HLEN', KEYS[1]) % (#ARGV - 3)]
+end
+local member = {id=tonumber(ARGV[1]), channel=ARGV[2], nick=ARGV[3], colour=colour}
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(member))
+return redis.call('HVALS', KEYS[1])
+"""
+
+# KEYS: slots, presence, active parties, sessions. ARGV: member id, member limit, now, party id, session key.
+# Returns 1 if the member got (or already had) one of the party's slots, 0 if the party is full.
+ADMIT = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    if redis.call('SCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+        return 0
+    end
+    redis.call('SADD', KEYS[1], ARGV[1])
+end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[4])
+redis.call('HSET', KEYS[4], ARGV[5], ARGV[1])
+return 1
+"""
+
+# KEYS: members, colours, slots, presence. ARGV: member id, channel (optional).
+# Frees the member's slot and returns the departed member, or nil if it had not said hello.
+# Given a channel, does nothing (and returns nil) if the member has since been resumed on another one.
+LEAVE = """
+if ARGV[2] then
+    local current = redis.call('HGET', KEYS[1], ARGV[1])
+    if current and cjson.decode(current)['channel'] ~= ARGV[2] then
+        return nil
+    end
+end
+redis.call('SREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+local member = redis.call('HGET', KEYS[1], ARGV[1])
+if not member then
+    return nil
+end
+local colour = cjson.decode(member)['colour']
+if colour ~= cjson.null and redis.call('HGET', KEYS[2], colour) == ARGV[1] then
+    redis.call('HDEL', KEYS[2], colour)
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+return member
+"""
+
+# KEYS: members, slots, presence, active parties. ARGV: member id, new channel, now, party id.
+# Moves a member that still holds its slot onto a new channel and returns it as it was, or nil if it has gone.
+RESUME = """
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 0 then
+    return nil
+end
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+if not previous then
+    return nil
+end
+local member = cjson.decode(previous)
+member['channel'] = ARGV[2]
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(member))
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[1])
+redis.call('ZADD', KEYS[4], ARGV[3], ARGV[4])
+return previous
+"""
+
+# Every queue change bumps the playlist version and is logged (briefly) as an op, so broadcasts can send deltas.
+OP_LOG_LENGTH = 100
+
+# Queue positions are fractional, so a song can always be put between two others by changing only its own score.
+# Positions go back to Python as strings, since Redis truncates Lua numbers to integers.
+
+# KEYS: playlist, version, ops. ARGV: song id, op log length.
+# Appends the song and returns {position, version}, with position false if the song was already queued.
+ADD_TO_QUEUE = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return {false, false}
+end
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+local position = math.floor(tonumber(last[2] or '0')) + 1
+redis.call('ZADD', KEYS[1], position, ARGV[1])
+local version = redis.call('INCR', KEYS[2])
+redis.call('RPUSH', KEYS[3], cjson.encode({op='add', song=tonumber(ARGV[1]), version=version}))
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[2]), -1)
+return {string.format('%.17g', position), version}
+"""
+
+# KEYS: playlist, version, ops. ARGV: song id, 'front', 'up' or 'down', op log length.
+# Returns {position, version, renumbered}, or false if the song isn't queued or can't move that way.
+# Moving between two songs takes the midpoint of their positions. In the rare case that leaves no room (the
+# positions are adjacent doubles), the whole queue is renumbered first and renumbered is every {song, position}.
+MOVE_IN_QUEUE = """
+local rank = redis.call('ZRANK', KEYS[1], ARGV[1])
+if not rank then
+    return false
+end
+local index, first, last
+if ARGV[2] == 'front' then
+    if rank == 0 then
+        return false
+    end
+    index = 0
+    first, last = 0, 0
+elseif ARGV[2] == 'up' then
+    if rank == 0 then
+        return false
+    end
+    index = rank - 1
+    first, last = math.max(rank - 2, 0), rank - 1
+else
+    index = rank + 1
+    first, last = rank + 1, rank + 2
+end
+local neighbours = redis.call('ZRANGE', KEYS[1], first, last, 'WITHSCORES')
+if #neighbours == 0 then
+    return false
+end
+local position
+local renumbered = {}
+if ARGV[2] == 'front' or (#neighbours == 2 and ARGV[2] == 'up') then
+    position = tonumber(neighbours[2]) - 1
+elseif #neighbours == 2 then
+    position = tonumber(neighbours[2]) + 1
+else
+    local a, b = tonumber(neighbours[2]), tonumber(neighbours[4])
+    position = (a + b) / 2
+    if position == a or position == b then
+        local songs = redis.call('ZRANGE', KEYS[1], 0, -1)
+        for i, song in ipairs(songs) do
+            redis.call('ZADD', KEYS[1], i, song)
+            renumbered[i] = {tonumber(song), i}
+        end
+        -- The neighbours are now at ranks first and last, so 1-based positions first + 1 and last + 1.
+        position = first + 1.5
+    end
+end
+redis.call('ZADD', KEYS[1], position, ARGV[1])
+local version = redis.call('INCR', KEYS[2])
+redis.call('RPUSH', KEYS[3], cjson.encode({op='move', song=tonumber(ARGV[1]), index=index, version=version}))
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[3]), -1)
+return {string.format('%.17g', position), version, renumbered}
+"""
+
+# KEYS: playlist, version, ops. ARGV: op log length.
+# Takes the song at the front of the queue and returns {song, version}, or {false, false} if the queue is empty.
+POP_QUEUE = """
+local song = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+if not song then
+    return {false, false}
+end
+redis.call('ZREM', KEYS[1], song)
+local version = redis.call('INCR', KEYS[2])
+redis.call('RPUSH', KEYS[3], cjson.encode({op='remove', song=tonumber(song), version=version}))
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[1]), -1)
+return {song, version}
+"""
+
+# KEYS: playlist, version, ops. ARGV: song id, op log length.
+# Returns the new version, or false if the song was not queued.
+REMOVE_FROM_QUEUE = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local version = redis.call('INCR', KEYS[2])
+redis.call('RPUSH', KEYS[3], cjson.encode({op='remove', song=tonumber(ARGV[1]), version=version}))
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[2]), -1)
+return version
+"""
+
+# KEYS: broadcast lock, version, broadcast version, ops, playlist.
+# Releases the broadcast lock and returns {last broadcast version, version, ops, playlist}.
+TAKE_BROADCAST = """
+redis.call('DEL', KEYS[1])
+local version = tonumber(redis.call('GET', KEYS[2]) or '0')
+local previous = tonumber(redis.call('GETSET', KEYS[3], version) or '0')
+return {previous, version, redis.call('LRANGE', KEYS[4], 0, -1), redis.call('ZRANGE', KEYS[5], 0, -1)}
+"""
+
+
+_scripts = {}
+
+
+class PartyState:
+    """Live state of a party, kept in Redis.
+
+    Postgres remains the durable copy; every change made here is also handed to the party.persist worker
+    (see consumer.PartyPersistConsumer), so the realtime path never waits on it.
+    """
+    def __init__(self, party_id):
+        self.party_id = party_id
+        self.group_name = f"party-{party_id}"
+        self.redis = get_redis(party_id)
+        prefix = f"party:{party_id}"
+        self.loaded_key = f"{prefix}:loaded"
+        self.loading_key = f"{prefix}:loading"
+        self.members_key = f"{prefix}:members"
+        self.slots_key = f"{prefix}:slots"
+        self.presence_key = f"{prefix}:presence"
+        self.sessions_key = f"{prefix}:sessions"
+        self.colours_key = f"{prefix}:colours"
+        self.playlist_key = f"{prefix}:playlist"
+        self.version_key = f"{prefix}:version"
+        self.broadcast_version_key = f"{prefix}:broadcast_version"
+        self.ops_key = f"{prefix}:ops"
+        self.broadcast_lock_key = f"{prefix}:broadcast_lock"
+
+    def _script(self, source, keys, args):
+        if source not in _scripts:
+            _scripts[source] = self.redis.register_script(source)
+        return _scripts[source](keys=keys, args=args, client=self.redis)
+
+    def ensure_loaded(self):
+        """Copies the party's playlist and members from Postgres into Redis, unless that's been done already.
+
+        Only one caller loads; anyone else arriving meanwhile waits until it has finished, rather than carrying on
+        with an empty playlist and slot set.
+        """
+        while not self.redis.expire(self.loaded_key, LOADED_TTL):
+            if self.redis.set(self.loading_key, 1, nx=True, ex=LOAD_TIMEOUT):
+                try:
+                    self._load()
+                except Exception:
+                    self.redis.delete(self.loading_key)
+                    raise
+                return
+            time.sleep(LOAD_POLL_INTERVAL)
+
+    def _load(self):
+        entries = (Playlist.objects.filter(party_id=self.party_id).order_by('position', 'id')
+                   .values_list('song_id', 'position'))
+        members = list(PartyMember.objects.filter(party_id=self.party_id).values('id', 'channel', 'nick', 'colour'))
+        # If the flag expired while the party was still live, what's in Redis is newer than Postgres, so keep it.
+        with self.redis.pipeline() as pipe:
+            for song, position in entries:
+                pipe.execute_command('ZADD', self.playlist_key, 'NX', repr(position), song)
+            now = time.time()
+            for member in members:
+                pipe.sadd(self.slots_key, member['id'])
+                # Give members we only know about from Postgres a chance to check in before they're swept.
+                pipe.execute_command('ZADD', self.presence_key, 'NX', now, member['id'])
+                if member['nick'] is None:
+                    continue
+                pipe.hsetnx(self.members_key, member['id'], json.dumps(member))
+                if member['colour']:
+                    pipe.hsetnx(self.colours_key, member['colour'], member['id'])
+            pipe.set(self.loaded_key, 1, ex=LOADED_TTL)
+            pipe.delete(self.loading_key)
+            pipe.execute()
+
+    def admit(self, member_id, limit, session_key):
+        """Atomically takes one of the party's limit slots for the member, returning False if they're all taken.
+
+        The member is remembered as the session's, so that if the same browser reconnects we can replace it.
+        """
+        return bool(self._script(ADMIT, [self.slots_key, self.presence_key, ACTIVE_KEY, self.sessions_key],
+                                 [member_id, limit, time.time(), self.party_id, session_key]))
+
+    def session_member(self, session_key):
+        """Returns the id of the member the session was last admitted as, which may since have left."""
+        member_id = self.redis.hget(self.sessions_key, session_key)
+        return int(member_id) if member_id else None
+
+    def heartbeat(self, member_id):
+        now = time.time()
+        with self.redis.pipeline(transaction=False) as pipe:
+            # XX: a member that has already been swept stays gone.
+            pipe.execute_command('ZADD', self.presence_key, 'XX', now, member_id)
+            pipe.execute_command('ZADD', ACTIVE_KEY, now, self.party_id)
+            pipe.execute()
+
+    def stale_members(self, before):
+        return [int(x) for x in self.redis.zrangebyscore(self.presence_key, '-inf', before)]
+
+    def join(self, member_id, channel, nick):
+        members = [json.loads(x) for x in self._script(JOIN, [self.members_key, self.colours_key],
+                                                       [member_id, channel, nick] + COLOURS)]
+        member = next(x for x in members if x['id'] == member_id)
+        return member, members
+
+    def resume(self, member_id, channel):
+        """Reattaches a member that still holds its slot to a new channel, keeping its nick and colour.
+
+        Returns the member as it was before (so with its old channel), or None if it has already left or was swept.
+        """
+        member = self._script(RESUME, [self.members_key, self.slots_key, self.presence_key, ACTIVE_KEY],
+                              [member_id, channel, time.time(), self.party_id])
+        return json.loads(member) if member else None
+
+    def leave(self, member_id, channel=None):
+        """Removes the member, or if channel is given, only if nobody has resumed it on another channel since."""
+        member = self._script(LEAVE, [self.members_key, self.colours_key, self.slots_key, self.presence_key],
+                              [member_id] + ([channel] if channel else []))
+        return json.loads(member) if member else None
+
+    def member_channels(self):
+        return {json.loads(x)['channel'] for x in self.redis.hvals(self.members_key)}
+
+    def playlist(self):
+        with self.redis.pipeline() as pipe:
+            pipe.get(self.version_key)
+            pipe.zrange(self.playlist_key, 0, -1)
+            version, playlist = pipe.execute()
+        return int(version or 0), [int(x) for x in playlist]
+
+    def add_to_queue(self, song_id):
+        position, version = self._script(ADD_TO_QUEUE, [self.playlist_key, self.version_key, self.ops_key],
+                                         [song_id, OP_LOG_LENGTH])
+        return float(position) if position else None, version or None
+
+    def move_in_queue(self, song_id, direction):
+        """Moves a queued song to the front, or up or down one place.
+
+        Returns (position, version, renumbered), where renumbered is a list of every (song, position) if the whole
+        queue had to be renumbered to make room, or (None, None, None) if nothing moved.
+        """
+        result = self._script(MOVE_IN_QUEUE, [self.playlist_key, self.version_key, self.ops_key],
+                              [song_id, direction, OP_LOG_LENGTH])
+        if not result:
+            return None, None, None
+        position, version, renumbered = result
+        return float(position), version, [tuple(x) for x in renumbered] or None
+
+    def pop_queue(self):
+        """Takes the next song off the queue, returning (song, version), or (None, None) if it was empty."""
+        song, version = self._script(POP_QUEUE, [self.playlist_key, self.version_key, self.ops_key], [OP_LOG_LENGTH])
+        return int(song) if song else None, version or None
+
+    def remove_from_queue(self, song_id):
+        return self._script(REMOVE_FROM_QUEUE, [self.playlist_key, self.version_key, self.ops_key],
+                            [song_id, OP_LOG_LENGTH]) or None
+
+    def claim_broadcast(self, timeout):
+        """Returns True if the caller should broadcast the playlist; anyone else changing it meanwhile need not."""
+        return bool(self.redis.set(self.broadcast_lock_key, 1, nx=True, px=int(timeout * 1000)))
+
+    def take_broadcast(self):
+        """Returns (previous version, version, ops since previous version, playlist) and releases the lock.
+
+        ops is None if the log no longer reaches back to the previous broadcast.
+        """
+        previous, version, ops, playlist = self._script(TAKE_BROADCAST, [
+            self.broadcast_lock_key, self.version_key, self.broadcast_version_key, self.ops_key, self.playlist_key,
+        ], [])
+        ops = [x for x in (json.loads(op) for op in ops) if x['version'] > previous]
+        if version > previous and (not ops or ops[0]['version'] != previous + 1):
+            ops = None
+        return previous, version, ops, [int(x) for x in playlist]
+
+    def clear(self):
+        """Forgets everything about the party in Redis."""
+        with self.redis.pipeline() as pipe:
+            pipe.delete(*(value for name, value in vars(self).items() if name.endswith('_key')))
+            pipe.zrem(ACTIVE_KEY, self.party_id)
+            pipe.execute()
@@ -0,0 +1,35 @@
+import hashlib
+
+import redis
+from django.conf import settings
+
+_connection = None
+_shards = {}
+
+
+def rendezvous(key, shards):
+    """Picks the shard for key by rendezvous hashing: adding a shard only moves the keys that now prefer it."""
+    return max(shards, key=lambda shard: hashlib.md5(f"{shard}|{key}".encode()).digest())
+
+
+def get_redis(shard_key=None):
+    """Returns the Redis connection for shard_key (a party id) if REDIS_SHARD_URLS is set, otherwise REDIS_URL's."""
+    global _connection
+    if shard_key is not None and settings.REDIS_SHARD_URLS:
+        return _shard(rendezvous(shard_key, settings.REDIS_SHARD_URLS))
+    if _connection is None:
+        _connection = redis.StrictRedis.from_url(settings.REDIS_URL)
+    return _connection
+
+
+def get_redis_shards():
+    """Returns a connection to every shard that party state can live on."""
+    if not settings.REDIS_SHARD_URLS:
+        return [get_redis()]
+    return [_shard(url) for url in settings.REDIS_SHARD_URLS]
+
+
+def _shard(url):
+    if url not in _shards:
+        _shards[url] = redis.StrictRedis.from_url(url)
+    return _shards[url]
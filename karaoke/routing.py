@@ -1,9 +1,12 @@
-from channels.routing import route
+from django.conf.urls import url
 
-from .consumer import party_connected, party_disconnected, party_message
+from .consumer import PartyConsumer, PartyPersistConsumer, TracklistPublishConsumer
 
-karaoke_routing = [
-    route("websocket.connect", party_connected, path=r"^/party/(?P<party_id>[a-zA-Z0-9_-]+)"),
-    route("websocket.receive", party_message),
-    route("websocket.disconnect", party_disconnected)
+websocket_urlpatterns = [
+    url(r"^karaoke/party/(?P<party_id>[a-zA-Z0-9_-]+)", PartyConsumer),
 ]
+
+channel_routes = {
+    "party.persist": PartyPersistConsumer,
+    "tracklist.publish": TracklistPublishConsumer,
+}
@@ -0,0 +1,69 @@
+import base64
+import json
+
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from .models import Song
+from .tracklist import entry
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+class BadQuery(ValueError):
+    pass
+
+
+def encode_cursor(song):
+    return base64.urlsafe_b64encode(json.dumps([song.artist_key, song.title_key, song.id]).encode('utf-8')).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        artist, title, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(artist), str(title), int(id)
+    except (ValueError, TypeError):
+        raise BadQuery("bad cursor")
+
+
+def search(params):
+    songs = Song.objects.annotate(artist_key=Lower('artist'), title_key=Lower('title'))
+
+    q = params.get('q', '').strip().lower()
+    if q:
+        if params.get('match') == 'prefix':
+            songs = songs.filter(Q(title_key__startswith=q) | Q(artist_key__startswith=q))
+        else:
+            songs = songs.filter(Q(title_key__contains=q) | Q(artist_key__contains=q))
+    if 'language' in params:
+        songs = songs.filter(language=params['language'])
+    if 'genre' in params:
+        songs = songs.filter(genre=params['genre'])
+    if 'year' in params:
+        try:
+            songs = songs.filter(song_year=int(params['year']))
+        except ValueError:
+            raise BadQuery("bad year")
+    if 'duet' in params:
+        songs = songs.filter(parts__isnull=params['duet'] not in ('1', 'true'))
+
+    if 'after' in params:
+        songs = songs.extra(where=["(lower(artist), lower(title), karaoke_song.id) > (%s, %s, %s)"],
+                            params=decode_cursor(params['after']))
+
+    try:
+        limit = min(int(params.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        raise BadQuery("bad limit")
+    if limit < 1:
+        raise BadQuery("bad limit")
+
+    page = list(songs.order_by('artist_key', 'title_key', 'id')
+                .only('id', 'title', 'artist', 'length', 'cover_image', 'parts', 'notes', 'preview', 'replay_gain')
+                [:limit + 1])
+    return {
+        'results': [entry(x.id, x.title, x.artist, x.length, x.cover_image, x.parts, x.notes, x.preview, x.replay_gain)
+                    for x in page[:limit]],
+        'next': encode_cursor(page[limit - 1]) if len(page) > limit else None,
+    }
@@ -1,3 +1,221 @@
-from django.test import TestCase
+import secrets
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, TestCase
+
+from .asgi import parse_range
+from .consumer import PartyConsumer, PartyPersistConsumer, splice_relay
+from .models import Party, Playlist, Song
+from .party_state import COLOURS, PartyState
+
+# The queue tests need the Redis at REDIS_URL; they only touch their own party's keys, and remove them afterwards.
+
+
+class RecordingConsumer(PartyConsumer):
+    """A PartyConsumer with no socket or channel layer, which keeps whatever it would have sent."""
+    def __init__(self, party_id):
+        super().__init__({'type': 'websocket'})
+        self.party_id = party_id
+        self.state = PartyState(party_id)
+        self.peers = set()
+        self.persisted = []
+        self.sent = []
+        self.layer_sent = []
+
+    async def persist(self, type, **change):
+        self.persisted.append(dict(change, type=type))
+
+    async def playlist_changed(self):
+        pass
+
+    async def send_json(self, content, close=False):
+        self.sent.append(content)
+
+    async def layer_send(self, channel, message):
+        self.layer_sent.append((channel, message))
+
+
+class QueueTests(TestCase):
+    def setUp(self):
+        self.party = Party.objects.create(id=secrets.token_hex(5))
+        self.state = PartyState(self.party.id)
+        self.addCleanup(self.state.clear)
+        Song.objects.bulk_create([Song(title=f"Song {i}", artist="Artist", genre="Pop", language="English", length=180,
+                                       cover_image="cover.jpg") for i in range(4)])
+        self.songs = list(Song.objects.order_by('-id').values_list('id', flat=True)[:4])[::-1]
+        for song in self.songs:
+            position, _ = self.state.add_to_queue(song)
+            Playlist.objects.create(party=self.party, song_id=song, position=position)
+
+    def positions(self):
+        return [(int(song), score) for song, score in
+                self.state.redis.zrange(self.state.playlist_key, 0, -1, withscores=True)]
+
+    def test_add_appends(self):
+        self.assertEqual(self.positions(), list(zip(self.songs, [1.0, 2.0, 3.0, 4.0])))
+        self.assertEqual(self.state.add_to_queue(self.songs[0]), (None, None))
+
+    def test_move_up_takes_midpoint(self):
+        a, b, c, d = self.songs
+        position, _, renumbered = self.state.move_in_queue(c, 'up')
+        self.assertEqual((position, renumbered), (1.5, None))
+        self.assertEqual(self.state.playlist()[1], [a, c, b, d])
+
+    def test_move_up_to_front(self):
+        a, b, c, d = self.songs
+        self.assertEqual(self.state.move_in_queue(b, 'up')[0], 0.0)
+        self.assertEqual(self.state.playlist()[1], [b, a, c, d])
+
+    def test_move_down_takes_midpoint(self):
+        a, b, c, d = self.songs
+        self.assertEqual(self.state.move_in_queue(b, 'down')[0], 3.5)
+        self.assertEqual(self.state.playlist()[1], [a, c, b, d])
+
+    def test_move_down_to_back(self):
+        a, b, c, d = self.songs
+        self.assertEqual(self.state.move_in_queue(c, 'down')[0], 5.0)
+        self.assertEqual(self.state.playlist()[1], [a, b, d, c])
+
+    def test_move_to_front(self):
+        a, b, c, d = self.songs
+        self.assertEqual(self.state.move_in_queue(d, 'front')[0], 0.0)
+        self.assertEqual(self.state.playlist()[1], [d, a, b, c])
+
+    def test_moves_that_go_nowhere(self):
+        a, b, c, d = self.songs
+        version = self.state.playlist()[0]
+        for song, direction in ((a, 'front'), (a, 'up'), (d, 'down')):
+            self.assertEqual(self.state.move_in_queue(song, direction), (None, None, None))
+        self.assertEqual(self.state.move_in_queue(-1, 'up'), (None, None, None))
+        self.assertEqual(self.state.playlist(), (version, self.songs))
+
+    def test_renumber_when_gap_exhausted(self):
+        consumer = RecordingConsumer(self.party.id)
+        # Keep moving the last song up, halving the gap between the songs before it, until there's no room left.
+        for moves in range(1, 200):
+            song = self.state.playlist()[1][-1]
+            async_to_sync(consumer.move_in_queue)({'song': song, 'direction': 'up'})
+            if consumer.persisted[-1]['type'] == 'queue.renumber':
+                break
+        else:
+            self.fail("queue was never renumbered")
+        self.assertGreater(moves, 40)
+        self.assertTrue(all(x['type'] == 'queue.move' for x in consumer.persisted[:-1]))
+
+        renumber = consumer.persisted[-1]
+        playlist = self.state.playlist()[1]
+        self.assertEqual(sorted(x for x, _ in renumber['positions']), sorted(self.songs))
+        # The others are renumbered 1..n in their old order, and the moved song goes halfway between its new neighbours.
+        self.assertEqual(self.positions(), [(playlist[0], 1.0), (playlist[1], 2.0), (song, 2.5), (playlist[3], 3.0)])
+        self.assertEqual(sorted(renumber['positions']), sorted([list(x) for x in self.positions()]))
+
+        worker = PartyPersistConsumer({'type': 'channel'})
+        for message in consumer.persisted:
+            getattr(worker, message['type'].replace('.', '_'))(message)
+        stored = Playlist.objects.filter(party=self.party).order_by('position').values_list('song_id', 'position')
+        self.assertEqual(list(stored), self.positions())
+
+    def test_pop_queue(self):
+        consumer = RecordingConsumer(self.party.id)
+        for song in self.songs:
+            async_to_sync(consumer.pop_queue)({})
+            self.assertEqual(consumer.sent[-1], {"action": "next_song", "song": song})
+        self.assertEqual([x['song'] for x in consumer.persisted], self.songs)
+
+    def test_pop_empty_queue(self):
+        for song in self.songs:
+            self.state.remove_from_queue(song)
+        version = self.state.playlist()[0]
+        self.assertEqual(self.state.pop_queue(), (None, None))
+        self.assertEqual(self.state.playlist(), (version, []))
+
+        consumer = RecordingConsumer(self.party.id)
+        async_to_sync(consumer.pop_queue)({})
+        self.assertEqual(consumer.sent, [{"action": "next_song", "song": None}])
+        self.assertEqual(consumer.persisted, [])
+
+
+class JoinTests(TestCase):
+    def setUp(self):
+        self.state = PartyState(secrets.token_hex(5))
+        self.addCleanup(self.state.clear)
+
+    def test_colours_are_shared_once_all_taken(self):
+        colours = [self.state.join(i, f'specific.test!{i}', f'member {i}')[0]['colour'] for i in range(1, 10)]
+        self.assertEqual(colours[:len(COLOURS)], COLOURS)
+        self.assertEqual(colours[len(COLOURS):], COLOURS[:3])
+        # A member saying hello again keeps its colour.
+        self.assertEqual(self.state.join(2, 'specific.test!2', 'member 2')[0]['colour'], COLOURS[1])
+
+
+class RelayTests(TestCase):
+    def setUp(self):
+        self.party = Party.objects.create(id=secrets.token_hex(5))
+        self.state = PartyState(self.party.id)
+        self.addCleanup(self.state.clear)
+        self.consumer = RecordingConsumer(self.party.id)
+        self.consumer.channel_name = 'specific.test!alice'
+        self.state.join(1, self.consumer.channel_name, 'alice')
+        self.state.join(2, 'specific.test!bob', 'bob')
+
+    def test_relays_to_members(self):
+        async_to_sync(self.consumer.splice)(('specific.test!bob', 'message', '1'))
+        async_to_sync(self.consumer.relay)({'target': 'specific.test!bob', 'messages': [1, 2]})
+        self.assertEqual([channel for channel, _ in self.consumer.layer_sent], ['specific.test!bob'] * 2)
+
+    def test_drops_other_targets(self):
+        for target in ('party.persist', 'specific.test!carol'):
+            async_to_sync(self.consumer.splice)((target, 'message', '1'))
+            async_to_sync(self.consumer.relay)({'target': target, 'message': 1})
+        self.assertEqual(self.consumer.layer_sent, [])
+
+    def test_sees_new_members(self):
+        async_to_sync(self.consumer.splice)(('specific.test!bob', 'message', '1'))
+        self.state.join(3, 'specific.test!carol', 'carol')
+        async_to_sync(self.consumer.splice)(('specific.test!carol', 'message', '1'))
+        self.assertEqual([channel for channel, _ in self.consumer.layer_sent],
+                         ['specific.test!bob', 'specific.test!carol'])
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 100))
+        self.assertEqual(parse_range('bytes=500-', 1000), (500, 1000))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 1000))
+        self.assertEqual(parse_range('bytes=900-5000', 1000), (900, 1000))
+        self.assertEqual(parse_range('bytes=-5000', 1000), (0, 1000))
+        self.assertEqual(parse_range('bytes= 3-', 10), (3, 10))
+
+    def test_unsatisfiable(self):
+        self.assertIs(parse_range('bytes=1000-', 1000), False)
+        self.assertIs(parse_range('bytes=-0', 1000), False)
+
+    def test_ignored(self):
+        for value in ('bytes=5-2', 'items=0-1', 'bytes=a-b', 'bytes=-', 'bytes=0-1,5-6', 'bytes'):
+            self.assertIsNone(parse_range(value, 1000), value)
+
+
+class SpliceRelayTests(SimpleTestCase):
+    prefix = '{"action":"relay","target":"specific.abc!def"'
+
+    def test_message(self):
+        self.assertEqual(splice_relay(self.prefix + ',"message":{"sdp":"v=0\\r\\n"}}'),
+                         ('specific.abc!def', 'message', '{"sdp":"v=0\\r\\n"}'))
+
+    def test_messages(self):
+        self.assertEqual(splice_relay(self.prefix + ',"messages":[1,{"a":[]}]}'),
+                         ('specific.abc!def', 'messages', '[1,{"a":[]}]'))
+
+    def test_falls_back(self):
+        for text in (
+            '{"action":"addToQueue","song":1}',
+            '{"action":"relay","target":"a\\"b","message":1}',
+            self.prefix + '}',
+            self.prefix + ',"message":1,"extra":2}',
+            self.prefix + ',"message":{"a":1}',
+            self.prefix + ',"message":{"a":}}',
+            self.prefix + ',"messages":{"a":1}}',
+            self.prefix + ',"message":{"a":NaN}}',
+            self.prefix + ',"messages":[-Infinity]}',
+        ):
+            self.assertIsNone(splice_relay(text), text)
@@ -0,0 +1,149 @@
+import gzip
+import hashlib
+import json
+import secrets
+import time
+from collections import namedtuple
+
+import brotli
+import redis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from .models import Song
+from .redis_conn import get_redis
+
+VERSION_KEY = "tracklist:version"
+BLOB_KEY = "tracklist:{version}:{encoding}"
+ENCODINGS = ('br', 'gzip', 'identity')
+# Held by whichever process is rebuilding the snapshot. A build takes about a minute at 100k songs; if the holder dies,
+# the lock expires and someone else takes over.
+REBUILD_LOCK_KEY = "tracklist:rebuilding"
+REBUILD_LOCK_TIMEOUT = 300
+REBUILD_POLL_INTERVAL = 0.1
+# Song edits queue a rebuild on this channel (see TracklistPublishConsumer); QUEUED_KEY is set while one is waiting, so
+# a burst of edits queues just one.
+PUBLISH_CHANNEL = "tracklist.publish"
+QUEUED_KEY = "tracklist:queued"
+# Releases the lock only if it's still ours.
+RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then redis.call('del', KEYS[1]) end"
+
+Snapshot = namedtuple("Snapshot", "version blobs song_ids")
+
+_snapshot = None
+
+
+def entry(id, title, artist, length, cover, parts, notes, preview, replay_gain):
+    result = {
+        'id': id,
+        'title': title,
+        'artist': artist,
+        'length': length,
+        'cover': cover,
+    }
+    if parts is not None:
+        result['duet'] = parts
+    if notes is not None:
+        result['notes'] = notes
+    if preview is not None:
+        result['preview'] = preview
+    if replay_gain is not None:
+        result['gain'] = replay_gain
+    return result
+
+
+def serialize():
+    songs = Song.objects.order_by('id').values_list('id', 'title', 'artist', 'length', 'cover_image', 'parts', 'notes',
+                                                            'preview', 'replay_gain')
+    return json.dumps([entry(*song) for song in songs], separators=(',', ':')).encode('utf-8')
+
+
+def song_ids(content):
+    return frozenset(x['id'] for x in json.loads(content.decode('utf-8')))
+
+
+def build():
+    content = serialize()
+    version = hashlib.sha256(content).hexdigest()[:32]
+    blobs = {
+        'identity': content,
+        'gzip': gzip.compress(content, 9),
+        'br': brotli.compress(content),
+    }
+    return Snapshot(version, blobs, song_ids(content))
+
+
+def publish(snapshot=None):
+    global _snapshot
+    snapshot = snapshot or build()
+    r = get_redis()
+    with r.pipeline() as pipe:
+        for encoding, blob in snapshot.blobs.items():
+            pipe.set(BLOB_KEY.format(version=snapshot.version, encoding=encoding), blob, ex=86400 * 7)
+        pipe.set(VERSION_KEY, snapshot.version)
+        pipe.execute()
+    _snapshot = snapshot
+    return snapshot
+
+
+def invalidate():
+    get_redis().delete(VERSION_KEY)
+
+
+def schedule():
+    """Queues a rebuild on the tracklist.publish worker. The current snapshot is served until it's replaced."""
+    if get_redis().set(QUEUED_KEY, 1, nx=True, ex=REBUILD_LOCK_TIMEOUT):
+        async_to_sync(get_channel_layer().send)(PUBLISH_CHANNEL, {"type": "tracklist.publish"})
+
+
+def publish_scheduled():
+    """Publishes the rebuild schedule() queued."""
+    # Clear the flag before building, so that edits made meanwhile queue another rebuild.
+    get_redis().delete(QUEUED_KEY)
+    return publish()
+
+
+def _published(r):
+    """Returns the published snapshot, or None if there isn't a complete one."""
+    global _snapshot
+    version = r.get(VERSION_KEY)
+    if version is None:
+        return None
+    version = version.decode('utf-8')
+    if _snapshot is not None and _snapshot.version == version:
+        return _snapshot
+    blobs = r.mget([BLOB_KEY.format(version=version, encoding=x) for x in ENCODINGS])
+    if None in blobs:
+        return None
+    blobs = dict(zip(ENCODINGS, blobs))
+    _snapshot = Snapshot(version, blobs, song_ids(blobs['identity']))
+    return _snapshot
+
+
+def current():
+    """Returns the published snapshot, publishing a new one first if there isn't one.
+
+    Only one process rebuilds at a time. The rest carry on with the snapshot they last had while it does, or, if they
+    have none, wait for it to finish.
+    """
+    global _snapshot
+    r = get_redis()
+    try:
+        while True:
+            snapshot = _published(r)
+            if snapshot is not None:
+                return snapshot
+            token = secrets.token_hex(8)
+            if r.set(REBUILD_LOCK_KEY, token, nx=True, ex=REBUILD_LOCK_TIMEOUT):
+                try:
+                    return publish()
+                finally:
+                    r.eval(RELEASE, 1, REBUILD_LOCK_KEY, token)
+            if _snapshot is not None:
+                return _snapshot
+            time.sleep(REBUILD_POLL_INTERVAL)
+    except redis.RedisError:
+        # Keep serving whatever we last had if Redis goes away.
+        if _snapshot is None:
+            _snapshot = build()
+        return _snapshot
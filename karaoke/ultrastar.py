@@ -0,0 +1,180 @@
+"""UltraStar notes files.
+
+This module has no Django dependencies, so importmlk.py can use it directly.
+
+read_header() pulls the #KEY:value header out of a notes file without touching the note lines, and decode() picks an
+encoding for the whole file; both try cheap, exact checks before falling back to chardet on a bounded prefix.
+
+compile_notes() turns a notes file into the structure assets/js/lib/ultrastar/parser.ts builds, following the same
+rules. It is serialized as compact UTF-8 JSON, so the browser doesn't have to detect encodings or parse text:
+
+    {"v": 1, "metadata": {...}, "mp3": ..., "background": ..., "video": ..., "bpm": ..., "gap": ..., "start": ...,
+     "end": ..., "videogap": ..., "parts": [[[start, end, [[type, beat, length, pitch, text], ...]], ...], ...]}
+
+Timings stay in beats, which is what the client's display and scoring work in.
+"""
+import codecs
+import hashlib
+import json
+import re
+
+import chardet
+
+FORMAT_VERSION = 1
+CHARDET_LIMIT = 16 * 1024
+
+BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+_encoding_tag = re.compile(rb'^[ \t]*#ENCODING:[ \t]*([\w-]+)', re.IGNORECASE | re.MULTILINE)
+
+METADATA = {'TITLE': 'title', 'ARTIST': 'artist', 'CREATOR': 'creator', 'EDITION': 'edition',
+            'LANGUAGE': 'language', 'GENRE': 'genre', 'UPDATED': 'updated', 'COMMENT': 'comment', 'COVER': 'cover'}
+
+_number = re.compile(r'\s*([+-]?\d+(?:\.\d*)?|[+-]?\.\d+)')
+
+
+def _int(value):
+    # Like JavaScript's parseInt: leading digits only, None where it would give NaN.
+    match = _number.match(value)
+    return int(float(match.group(1))) if match else None
+
+
+def _float(value):
+    match = _number.match(value.replace(',', '.'))
+    return float(match.group(1)) if match else None
+
+
+def detect_encoding(content: bytes):
+    """Picks an encoding for content: a BOM, valid UTF-8, an #ENCODING tag, cp1252, and finally chardet."""
+    for bom, encoding in BOMS:
+        if content.startswith(bom):
+            return encoding
+    try:
+        content.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    tag = _encoding_tag.search(content)
+    if tag:
+        try:
+            encoding = codecs.lookup(tag.group(1).decode('ascii')).name
+            content.decode(encoding)
+            return encoding
+        except (LookupError, UnicodeDecodeError):
+            # Including the common "#ENCODING:AUTO".
+            pass
+    try:
+        content.decode('cp1252')
+        return 'cp1252'
+    except UnicodeDecodeError:
+        pass
+    return chardet.detect(content[:CHARDET_LIMIT])['encoding'] or 'latin-1'
+
+
+def decode(content: bytes):
+    return content.decode(detect_encoding(content), 'replace')
+
+
+def _header_end(content: bytes):
+    # Headers come before any note lines, so stop at the first line that isn't blank or a #command.
+    start = len(codecs.BOM_UTF8) if content.startswith(codecs.BOM_UTF8) else 0
+    while start < len(content):
+        end = content.find(b'\n', start)
+        if end < 0:
+            end = len(content)
+        line = content[start:end].strip()
+        if line and line[:1] != b'#':
+            return start
+        start = end + 1
+    return len(content)
+
+
+def read_header(content: bytes, name=None):
+    """Returns the #KEY:value fields at the top of an UltraStar file, or None if there aren't any."""
+    if content.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        # Not ASCII-compatible, so it can't be cut up as bytes.
+        lines = content.decode('utf-16', 'replace').split('\n')
+    else:
+        header = content[:_header_end(content)]
+        lines = decode(header).split('\n')
+    fields = {}
+    for line in lines:
+        line = line.strip()
+        if len(line) <= 1:
+            continue
+        if line[0] != '#':
+            break
+        try:
+            k, v = line.split(':', 1)
+        except ValueError:
+            print(f"Bad line {line} in {name or 'header'}")
+        else:
+            fields[k[1:]] = v
+    return fields or None
+
+
+def compile_notes(text: str):
+    song = {
+        'v': FORMAT_VERSION,
+        'metadata': {},
+        'mp3': None,
+        'background': None,
+        'video': None,
+        'bpm': None,
+        'gap': None,
+        'start': None,
+        'end': None,
+        'videogap': 0,
+        'parts': [],
+    }
+    metadata = song['metadata']
+    parts = song['parts']
+    part = []
+    line = [0, None, []]
+    for row in text.replace('\r', '').split('\n'):
+        if not row:
+            continue
+        kind = row[0]
+        if kind == '#':
+            command = row[1:].split(':', 1)[0]
+            value = row[len(command) + 2:]
+            command = command.upper()
+            if command in METADATA:
+                metadata[METADATA[command]] = value
+            elif command in ('MP3', 'BACKGROUND', 'VIDEO'):
+                song[command.lower()] = value
+            elif command in ('BPM', 'START', 'VIDEOGAP'):
+                song[command.lower()] = _float(value)
+            elif command in ('GAP', 'END'):
+                song[command.lower()] = _int(value)
+        elif kind == 'P':
+            if part:
+                if line[2]:
+                    part.append(line)
+                parts.append(part)
+                line = [0, None, []]
+                part = []
+        elif kind in ':*F':
+            fields = row.split(' ', 4)
+            beat, length, pitch = (_int(x) for x in (fields[1:4] + ['', '', ''])[:3])
+            line[2].append([kind, beat, length, pitch, fields[4] if len(fields) > 4 else ''])
+        elif kind == '-':
+            fields = row.split(' ')
+            part.append(line)
+            start = _int(fields[1]) if len(fields) > 1 else None
+            end = _int(fields[2]) if len(fields) > 2 else None
+            line = [start, end or None, []]
+        elif kind == 'E':
+            part.append(line)
+            parts.append(part)
+            # parser.ts keeps reading after E, but nothing useful ever follows it.
+            break
+    return song
+
+
+def dumps(song):
+    return json.dumps(song, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def compiled_name(content: bytes):
+    """The content-addressed filename compiled notes are stored under, next to the song's other assets."""
+    return f"notes.{hashlib.sha256(content).hexdigest()[:16]}.json"
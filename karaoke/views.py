@@ -1,25 +1,27 @@
 import base64
 import hmac
-import json
-import random
+import secrets
 import string
 import time
-import datetime
 
 from django.conf import settings
+from django.db import connection
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import render, HttpResponse, get_object_or_404
-from django.views.decorators.http import condition, require_POST
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import ensure_csrf_cookie
 
-from .models import Party, PartyMember, Playlist, Song
+from . import metrics, search, tracklist
+from .models import Party
 
 # Create your views here.
 
 
 @ensure_csrf_cookie
 def index(request):
-    songs = Song.objects.all()
-    return render(request, "karaoke/index.html", {'songs': songs})
+    return render(request, "karaoke/index.html")
 
 
 @ensure_csrf_cookie
@@ -29,20 +31,36 @@ def party(request, party_id):
     username = ':'.join([str(now), str(party_id)])
     h = hmac.new(b'hello', msg=username.encode('utf-8'), digestmod='sha1').digest()
     h_encoded = base64.b64encode(h)
-    request.session['party_id'] = party.id
+    # Only touch the session when it changes, so that reloading the page doesn't cost a session write.
+    if request.session.get('party_id') != party.id:
+        request.session['party_id'] = party.id
     return render(request, "karaoke/party.html",
-                  {'party_id': party.id, 'turn_user': username, 'turn_pass': h_encoded})
+                  {'party_id': party.id, 'turn_user': username, 'turn_pass': h_encoded,
+                   'music_url': settings.MUSIC_URL})
+
+
+PARTY_ID_ALPHABET = string.ascii_letters + string.digits
+PARTY_ID_LENGTH = 8
+
+
+def allocate_party():
+    """Creates a party under a new random id in a single query, and returns the id.
+
+    With 62^8 possible ids a collision is vanishingly unlikely, but the insert is still conflict-safe and retried.
+    """
+    with connection.cursor() as cursor:
+        while True:
+            party_id = ''.join(secrets.choice(PARTY_ID_ALPHABET) for _ in range(PARTY_ID_LENGTH))
+            cursor.execute("INSERT INTO karaoke_party (id, created, max_members) VALUES (%s, now(), %s) "
+                           "ON CONFLICT (id) DO NOTHING RETURNING id",
+                           [party_id, Party._meta.get_field('max_members').default])
+            if cursor.fetchone():
+                return party_id
 
 
 @require_POST
 def create_party(request):
-    while True:
-        random_url = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(8))
-        if not Party.objects.filter(id=random_url).exists():
-            break
-    party = Party(id=random_url)
-    party.save()
-    return HttpResponse(random_url, content_type="text/plain")
+    return HttpResponse(allocate_party(), content_type="text/plain")
 
 
 def ntp(request):
@@ -51,10 +69,6 @@ def ntp(request):
     return HttpResponse(f"{now - browser_time}:{browser_time}")
 
 
-def track_listing_tag(request):
-    return f"lastsong-{Song.objects.latest('id').id}"
-
-
 def credits(request):
     return render(request, "karaoke/credits.html")
 
@@ -63,18 +77,39 @@ def faq(request):
     return render(request, "karaoke/faq.html")
 
 
-@condition(etag_func=track_listing_tag)
+def _preferred_encoding(request):
+    accepted = set(x.split(';')[0].strip() for x in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','))
+    for encoding in ('br', 'gzip'):
+        if encoding in accepted:
+            return encoding
+    return 'identity'
+
+
 def track_listing(request):
-    results = []
-    for song in Song.objects.all():
-        result = {
-            'id': song.id,
-            'title': song.title,
-            'artist': song.artist,
-            'length': song.length,
-            'cover': song.cover_image,
-        }
-        if song.parts is not None:
-            result['duet'] = song.parts
-        results.append(result)
-    return HttpResponse(json.dumps(results), content_type="application/json")
+    snapshot = tracklist.current()
+    encoding = _preferred_encoding(request)
+    etag = f'"{snapshot.version}-{encoding}"'
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(snapshot.blobs[encoding], content_type="application/json")
+        if encoding != 'identity':
+            response['Content-Encoding'] = encoding
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def song_search(request):
+    try:
+        results = search.search(request.GET)
+    except search.BadQuery as e:
+        return HttpResponseBadRequest(str(e), content_type="text/plain")
+    return JsonResponse(results)
+
+
+def metrics_listing(request):
+    if not metrics.enabled:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4")
@@ -1,6 +1,16 @@
+"""
+ASGI config for ponytone project.
+
+Serves both HTTP and websockets. Run one process per core, e.g. with
+gunicorn's uvicorn worker (see Procfile).
+"""
+
 import os
-from channels.asgi import get_channel_layer
+
+import django
+from channels.routing import get_default_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ponytone.settings")
+django.setup()
 
-channel_layer = get_channel_layer()
+application = get_default_application()
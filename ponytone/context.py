@@ -3,3 +3,7 @@ from django.conf import settings
 
 def google_analytics(request):
     return {'ga_tracking_id': settings.GA_TRACKING_ID}
+
+
+def deploy_version(request):
+    return {'deploy_version': settings.DEPLOY_VERSION}
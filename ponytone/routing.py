@@ -1,7 +1,18 @@
-from channels.routing import include
+from channels.http import AsgiHandler
+from django.conf import settings
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
+from channels.sessions import SessionMiddlewareStack
 
-from karaoke.routing import karaoke_routing
+from karaoke.asgi import FastPathRouter, MediaFiles
+from karaoke.routing import channel_routes, websocket_urlpatterns
 
-channel_routing = [
-    include(karaoke_routing, path="^/karaoke"),
-]
+media = {}
+if settings.MUSIC_ROOT:
+    media[settings.MUSIC_URL] = MediaFiles(settings.MUSIC_ROOT, settings.MUSIC_URL, settings.MUSIC_ACCEL_REDIRECT)
+
+application = ProtocolTypeRouter({
+    "http": FastPathRouter(AsgiHandler, media),
+    "websocket": AllowedHostsOriginValidator(SessionMiddlewareStack(URLRouter(websocket_urlpatterns))),
+    "channel": ChannelNameRouter(channel_routes),
+})
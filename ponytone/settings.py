@@ -69,6 +69,7 @@ TEMPLATES = [
                 # 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'ponytone.context.google_analytics',
+                'ponytone.context.deploy_version',
             ],
         },
     },
@@ -135,18 +136,69 @@ WEBPACK_LOADER = {
 
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379')
 
+# SESSION_STORE=redis keeps sessions in Redis instead of the django_session table.
+if os.environ.get('SESSION_STORE') == 'redis':
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+        "sessions": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": REDIS_URL,
+            "KEY_PREFIX": "session",
+        },
+    }
+    SESSION_ENGINE = "django.contrib.sessions.backends.cache"
+    SESSION_CACHE_ALIAS = "sessions"
+
+ASGI_APPLICATION = "ponytone.routing.application"
+
+# party.persist carries the write-back of live party state to Postgres, so it gets room to queue up (and time to sit)
+# while its worker catches up, rather than the default 100 messages for 60 seconds.
+CHANNEL_LAYER_OPTIONS = {
+    "channel_capacity": {"party.persist": int(os.environ.get('PARTY_PERSIST_CAPACITY', 100000))},
+    "expiry": int(os.environ.get('CHANNEL_LAYER_EXPIRY', 3600)),
+}
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "asgi_redis.RedisChannelLayer",
-        "CONFIG": {
-            "hosts": [REDIS_URL],
-        },
-        "ROUTING": "ponytone.routing.channel_routing",
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": dict(CHANNEL_LAYER_OPTIONS, hosts=[REDIS_URL]),
     },
 }
 
+# REDIS_SHARD_URLS=redis://a:6379,redis://b:6379 spreads parties over several Redis servers: each party's channel
+# layer traffic and live state go to one of them, picked by its id. REDIS_URL keeps everything else.
+REDIS_SHARD_URLS = [x for x in os.environ.get('REDIS_SHARD_URLS', '').split(',') if x]
+if REDIS_SHARD_URLS:
+    CHANNEL_LAYERS["default"] = {
+        "BACKEND": "karaoke.channel_layer.ShardedRedisChannelLayer",
+        "CONFIG": dict(CHANNEL_LAYER_OPTIONS, shards=REDIS_SHARD_URLS),
+    }
+
+# Queue changes within this many seconds of each other go out as one playlist broadcast.
+PLAYLIST_BROADCAST_WINDOW = float(os.environ.get('PLAYLIST_BROADCAST_WINDOW', 0.05))
+# Broadcast playlist changes as playlist_delta ops rather than the whole queue.
+PLAYLIST_DELTAS = 'PLAYLIST_DELTAS' in os.environ
+# Seconds a member whose websocket dropped is kept for, so a reconnect can resume it rather than rejoin.
+PARTY_RESUME_GRACE = float(os.environ.get('PARTY_RESUME_GRACE', 30))
+
+# Song files come from the S3 bucket behind MUSIC_URL, unless MUSIC_ROOT names a directory written by
+# `importmlk.py --media local`; the server then serves it at MUSIC_URL itself (see karaoke.asgi.MediaFiles).
+# MUSIC_ACCEL_REDIRECT, if set, is an internal nginx location for MUSIC_ROOT, and nginx sends the files instead.
+MUSIC_ROOT = os.environ.get('MUSIC_ROOT')
+MUSIC_URL = os.environ.get('MUSIC_URL', '/music/' if MUSIC_ROOT else 'https://music.ponytone.online/')
+MUSIC_ACCEL_REDIRECT = os.environ.get('MUSIC_ACCEL_REDIRECT')
+
+# Collect per-action websocket timings, summed across processes in the Redis at REDIS_URL and served in Prometheus
+# format at /metrics.
+PARTY_METRICS = 'PARTY_METRICS' in os.environ
+
 STATIC_ROOT = os.path.join(BASE_DIR, "bundles")
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 GA_TRACKING_ID = os.environ.get('GA_TRACKING_ID', None)
 
+# Keys the template fragment cache, so each deploy starts with fresh fragments.
+DEPLOY_VERSION = os.environ.get('GIT_REV', '')
+
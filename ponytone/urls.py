@@ -16,15 +16,17 @@ Including another URLconf
 from django.conf.urls import url, include
 from django.contrib import admin
 
-from karaoke.views import index, ntp, track_listing, party, credits, faq
+from karaoke.views import index, ntp, track_listing, song_search, party, credits, faq, metrics_listing
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^ntp$', ntp, name='ntp'),
+    url(r'^tracklist/search$', song_search, name='search'),
     url(r'^tracklist', track_listing, name='tracklist'),
     url(r'^$', index, name='index'),
     url(r'^credits$', credits, name='credits'),
     url(r'^faq$', faq, name='faq'),
+    url(r'^metrics$', metrics_listing, name='metrics'),
     url(r'^party/', include('karaoke.urls', namespace='karaoke')),
     url(r'^(?P<party_id>[a-zA-Z0-9]{8})$', party),
 ]